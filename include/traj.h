@@ -75,12 +75,25 @@ SHARED_EXPORT void Measurements_Table_Copy_Shape_Data( Measurements *table, int
 
 SHARED_EXPORT void Measurements_Table_Copy_Velocities( Measurements *table, int n_rows, double *buffer );
 
+// Returns the base of the shape data block and, through the arguments, the base
+// of the velocity block, the bytes between rows and the number of columns.
+// Use for zero-copy access to the buffers filled by the two functions above.
+SHARED_EXPORT double *Measurements_Table_Data_Base_And_Stride( Measurements *table, int n_rows, double **velocity, int *row_stride, int *n_cols );
+
 SHARED_EXPORT void Measurements_Table_Append_Columns_In_Place( Measurements *table, int n_rows, int n_cols_to_add );
 
 // Returns the number of rows with the queried state
 // Scans once over the table.
 SHARED_EXPORT int Measurements_Table_Size_Select_State( Measurements *table, int n_rows, int state );
 
+// Same as `Measurements_Table_Size_Select_State` for a table sorted by state.
+// Uses a binary search rather than a scan.
+SHARED_EXPORT int Measurements_Table_Size_Select_State_Sorted( Measurements *sorted_table, int n_rows, int state );
+
+// Adds the number of rows in each state in [0,out_len) to `out`.
+// Returns the number of rows with other states.  Scans once over the table.
+SHARED_EXPORT int Measurements_Table_State_Histogram( Measurements *table, int n_rows, int *out, int out_len );
+
 // Selects rows according to their state and returns the `time` and `valid_velocity` arrays.
 // time and mask should be the appropriate size. See `Measurements_Table_Size_Select_State`
 SHARED_EXPORT void Measurements_Table_Select_Time_And_Mask_By_State( Measurements *table, int n_rows, int state, double *time, int *mask );
@@ -93,6 +106,16 @@ SHARED_EXPORT void Measurements_Table_Select_Velocities_By_State( Measurements *
 // `data` should be the appropriate size. See `Measurements_Table_Size_Select_Velocities`
 SHARED_EXPORT void Measurements_Table_Select_Shape_By_State( Measurements *table, int n_rows, int state, double *data );
 
+// Selects rows according to their state and returns time, valid_velocity, shape
+// data and velocities together.  Scans once over the table.
+// Outputs should be the appropriate size. See `Measurements_Table_Size_Select_State`
+SHARED_EXPORT void Measurements_Table_Select_All_By_State( Measurements *table, int n_rows, int state, double *time, int *mask, double *shape, double *velocity );
+
+// Selects time, valid_velocity, shape data and velocities for all states 0 to
+// n_states-1 at once.  State k fills output rows offsets[k] to offsets[k+1].
+// `offsets` is the prefix sum of `Measurements_Table_State_Histogram` counts.
+SHARED_EXPORT void Measurements_Table_Select_All_States( Measurements *table, int n_rows, int n_states, int *offsets, double *time, int *mask, double *shape, double *velocity );
+
 SHARED_EXPORT void Enumerate_Measurements_Table( Measurements *table, int nrows );
 
 SHARED_EXPORT void Sort_Measurements_Table_State_Time( Measurements *table, int nrows );
@@ -105,6 +128,14 @@ SHARED_EXPORT void Sort_Measurements_Table_Time_Face( Measurements *table, int n
 
 SHARED_EXPORT void Sort_Measurements_Table_Time_State_Face( Measurements *table, int nrows );
 
+// Return nonzero if the table is in the order produced by the corresponding sort.
+// Scans once over the table.
+SHARED_EXPORT int Measurements_Table_Is_Sorted_By_State_Time( Measurements *table, int nrows );
+SHARED_EXPORT int Measurements_Table_Is_Sorted_By_Time( Measurements *table, int nrows );
+
+// Returns nonzero if any row has a valid velocity.
+SHARED_EXPORT int Measurements_Table_Any_Valid_Velocity( Measurements *table, int nrows );
+
 // Assumes `sorted_table` is sorted by Sort_Measurements_Table_State_Time
 SHARED_EXPORT void Measurements_Table_Compute_Velocities( Measurements *sorted_table, int n_rows );
 
@@ -12,8 +12,8 @@ import re
 
 def shape_from_whiskers(wvd):
   x,y = 0,0
-  for wv in wvd.itervalues():
-    for w in wv.itervalues():
+  for wv in wvd.values():
+    for w in wv.values():
       x = max(x,w.x.max())
       y = max(y,w.y.max())
   return x+1,y+1
@@ -31,15 +31,15 @@ def helper_face_point(shape, directive):
     if len(m.groups())==2:
       return tuple(map(int,m.groups()))
     else:
-      raise Exception, 'Could not interpret directive: %s'%directive
+      raise Exception('Could not interpret directive: %s'%directive)
   else:
     try:
       return helpers[directive]()
     except KeyError:
-      print "Available directives"
-      for k in helpers.iterkeys():
-        print '\t',k
-      raise Exception, 'Could not use supplied directive: %s'%directive
+      print("Available directives")
+      for k in helpers.keys():
+        print('\t%s'%k)
+      raise Exception('Could not use supplied directive: %s'%directive)
 
 def make_side_function(cx,cy):
   """ returns (follicle index, dx) """
@@ -50,13 +50,22 @@ def make_side_function(cx,cy):
 def make_comparitor(cx,cy):
   side = make_side_function(cx,cy)
   angle = lambda e: np.arctan2(e.y[side(e)]-cy,e.x[side(e)]-cx)
-  return lambda s,t: cmp( angle(s), angle(t) )
-
-def follicle_x(w,side):
+  return lambda s,t: (angle(s) > angle(t)) - (angle(s) < angle(t))
+
+def check_side(w,side):
+  """ Returns (follicle index, dx) for segment `w`.
+      `side` is either a follicle index (0 or -1) or a function like those
+      returned by `make_side_function`.
+  """
+  if callable(side):
+    return side(w)
+  return (0,1) if side==0 else (-1,-1)
+
+def follicle_x(w,side,dx=None):
   side,dx = check_side(w,side)
   return w.x[side]
 
-def follicle_y(w,side):
+def follicle_y(w,side,dx=None):
   side,dx = check_side(w,side)
   return w.y[side]
 
@@ -80,7 +89,7 @@ def root_angle_rad_old(w, side, dx, n=16):
     return np.arctan2( dx*np.diff(w.y[(-2*n):-n]), dx*np.diff(w.x[(-2*n):-n]) ).mean()
 
 def root_angle_rad(w,side,dx, n=16):
-  n = min(n, len(w.x)/4)
+  n = min(n, len(w.x)//4)
   L = cumulative_path_length(w)
   tt = L/L.max()
   teval = tt[n] if side==0 else tt[-n]
@@ -91,11 +100,11 @@ def root_angle_rad(w,side,dx, n=16):
   return np.arctan2( dx*np.polyval(yp,teval), dx*np.polyval(xp,teval) )
 
 def root_angle_deg(w, side, dx, n=16):
-  n = min(n, len(w.x)/2)
+  n = min(n, len(w.x)//2)
   return root_angle_rad(w,side,dx,n) * 180.0/np.pi
 
 def root_curvature(w,side,dx,n=16):
-  n = min(n, len(w.x)/4)
+  n = min(n, len(w.x)//4)
   L = cumulative_path_length(w)
   tt = L/L.max()
   teval = tt[n] if side==0 else tt[-n]
@@ -111,7 +120,7 @@ def root_curvature(w,side,dx,n=16):
   return dx*kappa(teval)
 
 def mean_curvature(w,side,dx,n=16):
-  n = min(n, len(w.x)/4)
+  n = min(n, len(w.x)//4)
   L = cumulative_path_length(w)
   tt = L/L.max()
   teval = tt[n] if side==0 else tt[-n]
@@ -129,3 +138,72 @@ def mean_curvature(w,side,dx,n=16):
 def time(w):
   return w.time
 
+#
+# Packed segments
+#
+# A sequence of segments packed into flat buffers so features can be computed
+# for all of them at once.  Segment i occupies [offsets[i],offsets[i+1]).
+#
+
+def pack_segments(segs):
+  """ Returns xs, ys, scores, thick, offsets """
+  offsets = np.zeros( len(segs)+1, dtype=np.intp )
+  offsets[1:] = np.cumsum( [len(w.x) for w in segs] )
+  pack = lambda attr: np.concatenate( [np.zeros(0)]+[getattr(w,attr) for w in segs] ).astype(np.float32)
+  return pack('x'), pack('y'), pack('scores'), pack('thick'), offsets
+
+def integrate_path_length_packed(xs,ys,offsets):
+  # steps between the last point of one segment and the first point of the
+  # next are cancelled by the difference of the cumulative sum
+  d = np.sqrt( np.diff(xs.astype(np.float64))**2 + np.diff(ys.astype(np.float64))**2 )
+  c = np.concatenate(([0],d.cumsum()))
+  return c[offsets[1:]-1] - c[offsets[:-1]]
+
+def median_packed(v,offsets):
+  n   = np.diff(offsets)
+  seg = np.repeat( np.arange(len(n)), n )
+  s   = v[ np.lexsort((v,seg)) ]  # sorted within each segment
+  lo  = offsets[:-1] + (n-1)//2
+  hi  = offsets[:-1] + n//2
+  return 0.5*( s[lo].astype(np.float64) + s[hi] )
+
+def follicle_packed(v,offsets,follicle):
+  """ Picks the follicle end of each segment.  `follicle` holds a follicle index (0 or -1) per segment. """
+  return v[ np.where( follicle==0, offsets[:-1], offsets[1:]-1 ) ]
+
+# Batched versions of the feature functions.  Each maps the packed segment
+# buffers and the follicle index of each segment to one value per segment.
+_packed = {
+  integrate_path_length : lambda xs,ys,scores,thick,offsets,follicle: integrate_path_length_packed(xs,ys,offsets),
+  median_score          : lambda xs,ys,scores,thick,offsets,follicle: median_packed(scores,offsets),
+  follicle_x            : lambda xs,ys,scores,thick,offsets,follicle: follicle_packed(xs,offsets,follicle),
+  follicle_y            : lambda xs,ys,scores,thick,offsets,follicle: follicle_packed(ys,offsets,follicle),
+}
+
+# Features that depend on which end of the segment is the follicle.
+# These are called as f(w,follicle,dx).
+_sided = set([ follicle_x, follicle_y, root_angle_rad, root_angle_deg, root_curvature, mean_curvature ])
+
+def extract_all(segs, funcs, out=None, side=0):
+  """ Returns a float32 array with a row for each segment and a column for each
+      function in `funcs`.  If supplied, `out` is filled and returned.
+
+      `side` locates the follicle end of each segment (see `check_side`).  The
+      default takes the first point of each segment.
+
+      The segments are packed once.  Features with a batched version are
+      computed for all segments at once; the rest are called segment by segment.
+  """
+  if out is None:
+    out = np.zeros( (len(segs),len(funcs)), dtype=np.float32 )
+  sides    = [ check_side(w,side) for w in segs ]
+  follicle = np.array( [f for f,dx in sides], dtype=int )
+  packed   = pack_segments(segs) + (follicle,)
+  for i,f in enumerate(funcs):
+    if f in _packed:
+      out[:,i] = _packed[f](*packed)
+    elif f in _sided:
+      out[:,i] = [ f(w,s,dx) for w,(s,dx) in zip(segs,sides) ]
+    else:
+      out[:,i] = [ f(w) for w in segs ]
+  return out
@@ -14,8 +14,10 @@ to the author. All other rights reserved.
 #           `feature` should be measurement or some such
 
 import features
-from numpy import zeros,array,histogram,linspace, float32, float64, log2, floor, diff, int32, ones, argmax
-from numpy import maximum
+from numpy import zeros,array,bincount, float32, float64, log2, floor, diff, int32, ones, argmax
+from numpy import maximum, arange, intp, ascontiguousarray, newaxis, argsort
+from numpy import int64, asarray, fromiter, sort, searchsorted, where, ndim, shape, concatenate, add
+from numpy import empty, prod
 import trace
 import pdb
 
@@ -39,7 +41,7 @@ class EmmissionDistributions(object):
       Whisker segments involved in some trajectory
 
   """
-  def __init__(self, states, classifier, wvd=None, traj=None, data = None):
+  def __init__(self, states, classifier, wvd=None, traj=None, data = None, side = 0):
     """
     Parameters:
     
@@ -48,6 +50,9 @@ class EmmissionDistributions(object):
 
     `classifier`: A function mapping wvd,traj,fid,wid to an index in states.
                   e.g: lambda wvd,traj,fid,wid: (fid,wid) in invtraj(traj)
+                  It is called once per segment unless it has a true
+                  `vectorized` attribute.  Then it is called once with
+                  arrays of fid's and wid's and must return an array.
 
     `wvd`: [optional] If specified, `traj` must also be specified.
            A whiskers dictionary.  Will be used to call
@@ -60,6 +65,11 @@ class EmmissionDistributions(object):
     `data`: [optional] A table supplied as a 2d ndarray to use as a set
             of feature vectors.  This must conform to the format expected
             internally.  
+
+    `side`: [optional] Locates the follicle end of each segment for the
+            side dependent features.  A follicle index (0 or -1) or a
+            function from `features.make_side_function`.  By default the
+            first point of each segment is used.
             
     """
     object.__init__(self)
@@ -70,103 +80,168 @@ class EmmissionDistributions(object):
                       ( "Follicle x position (px)" , features.follicle_x            ),
                       ( "Follicle y position (px)" , features.follicle_y            ))
     #bins for feature histograms
+    self._nbins = 16
     self._feature_bin_deltas = zeros( len(self._features) )
     self._feature_bin_mins   = zeros( len(self._features) )
+    self._feature_bin_inv_deltas = zeros( len(self._features) )
+    self._feature_index      = arange( len(self._features) ) # row of each feature in a state's distribution table
+    self._scratch_buffers    = {} # histogram work arrays reused across calls to estimate
+    self._side               = side
 
     self._states = states
     self._distributions  =  dict([(s,[]) for s in states]) # stored as log2( probability density )
+    self._stacked        = None # _distributions as one (state,feature,bin) array.  See `_stack_distributions`
     self._classifier = classifier
     if not (wvd is None or traj is None):
       self.estimate(wvd,traj,data)
 
   def feature(self, seg ):
-    return array([ f(seg) for name,f in self._features ])  
+    return self.batch_feature([seg])[0]
+
+  def batch_feature(self, segs, out = None):
+    """ Returns the feature vectors for a sequence of segments as the rows of an array.
+        If supplied, `out` is filled and returned. """
+    return features.extract_all( segs, [f for name,f in self._features], out=out, side=self._side )
   
+  def _scratch(self, name, shape, dtype=float64):
+    """ Returns an uninitialized work array.  The buffer is kept and only reallocated when it needs to grow. """
+    n = int( prod(shape) )
+    buf = self._scratch_buffers.get(name)
+    if buf is None or buf.dtype != dtype or buf.size < n:
+      buf = self._scratch_buffers[name] = empty( n, dtype=dtype )
+    return buf[:n].reshape(shape)
+
   @staticmethod
   def _count_whiskers(wvd):
-    nrows = 0
-    for fid,v in wvd.iteritems():
-      nrows += len(v)
-    return nrows
+    return sum( len(v) for v in wvd.values() )
+
+  @staticmethod
+  def _flatten_whiskers(wvd):
+    """ Returns arrays of frame id's and whisker id's and a parallel list of segments """
+    n = EmmissionDistributions._count_whiskers(wvd)
+    fids = zeros( n, dtype=int32 )
+    wids = zeros( n, dtype=int32 )
+    segs = []
+    i = 0
+    for fid,v in wvd.items():
+      j = i + len(v)
+      fids[i:j] = fid
+      wids[i:j] = list( v.keys() )
+      segs.extend( v.values() )
+      i = j
+    return fids,wids,segs
+
+  def _classify(self, wvd, traj, fids, wids):
+    """ Returns the class id's of the segments given by parallel arrays of fid's and wid's """
+    if getattr( self._classifier, 'vectorized', False ):
+      cls = self._classifier(wvd,traj,fids,wids)
+    else:
+      cls = [ self._classifier(wvd,traj,fid,wid) for fid,wid in zip(fids.tolist(),wids.tolist()) ]
+    return asarray( cls, dtype=int32 )
 
   def _all_features(self, wvd, traj):
-    data = zeros( ( self._count_whiskers(wvd), len(self._features)+3 ) ) #the extra 3 cols are for class id, fid, wid
-    def iter():
-      for fid,v in wvd.iteritems():
-        for wid,w in v.iteritems():
-          yield fid,wid,self.feature(w)
-    for i,(fid,wid,fv) in enumerate(iter()):
-      data[i,0] = self._classifier(wvd,traj,fid,wid)
-      data[i,1] = fid
-      data[i,2] = wid
-      data[i,3:] = fv
-    return data
-
-  def _update_feature_table(self,data):
-    self._feature_table = data #used in evaluate_by_lookup
-    self._feature_table_index = {}
-    for i,row in enumerate(data):
-      self._feature_table_index[ ( int(row[1]), int(row[2]) ) ] = i
+    """ Returns class id's, fid's, wid's and feature vectors as parallel arrays """
+    fids,wids,segs = self._flatten_whiskers(wvd)
+    cls = self._classify(wvd,traj,fids,wids)
+    return cls, fids, wids, self.batch_feature(segs) # not a scratch buffer: kept as the feature table
+
+  def _split_feature_table(self, wvd, traj, data):
+    """ Like `_all_features` but for a supplied table with columns: class id, fid, wid, features... """
+    fids = data[:,1].astype(int32)
+    wids = data[:,2].astype(int32)
+    cls  = self._classify(wvd,traj,fids,wids) # need to update classification even if data supplied
+    return cls, fids, wids, data[:,3:3+len(self._features)].astype(float32) # tables may carry extra measurement columns
+
+  def _update_feature_table(self, cls, fids, wids, feat):
+    self._cls  = cls
+    self._fid  = fids
+    self._wid  = wids
+    self._feat = feat #used in evaluate_by_lookup
+    self._feature_table_index = dict( (k,i) for i,k in enumerate( zip(fids.tolist(),wids.tolist()) ) )
 
   def estimate(self, wvd, traj, data = None):
-    nbins = 16
+    nbins = self._nbins
     if data is None:
-      data = self._all_features(wvd,traj)
+      self._update_feature_table( *self._all_features(wvd,traj) )
     else:
-      # need to update classification even if data supplied
-      for row in data:
-        row[0] = self._classifier(wvd,traj,row[1],row[2])
-    self._update_feature_table(data)
+      self._update_feature_table( *self._split_feature_table(wvd,traj,data) )
 
     nfeat = len(self._features)
     
-    for state in self._states:
-      self._distributions[state] = zeros( (nfeat,nbins) )
-
-    for i in xrange(nfeat):
-      ic = 3+i
-      v = data[:,ic]     # Determine bins to compute histograms over for each feature
-      #avg = v.mean()     # Bounds are limited to 3 times the standard deviation 
-      #wid = 3.0*v.std()  #  or the max/min; whichever gives the smaller interval.
-      mn  = v.min()      #
-      mx  = v.max()      #
-      b = linspace( mn, mx*(1.001) , nbins+1 )
-      self._feature_bin_deltas[i] = b[1] - b[0]
-      self._feature_bin_mins[i]   = b[0]
-
-      for istate,state in enumerate(self._states):
-        mask = data[:,0]==istate
-        counts,bb = histogram( v[mask], bins   = b )
-        counts = counts.astype(float64) + 1.0 #add one to each bin...gets rid of zeros
-        a = counts.copy()                  # a little blurring - extends distributions to cover things near what's been observed
-        a[1:] = maximum(a[1:],counts[:-1]) 
-        a[:-1] = maximum(a[:-1],counts[1:]) 
-        counts = a / a.sum()
-        #counts /= counts.sum()                #  FIXME: (line above) better way? what's the upper bound on the prob of a bin w 0
-        self._distributions[state][i] = log2(counts) # all counts>0
+    nstates = len(self._states)
+    state_col = self._cls.astype(intp)
+    valid = state_col >= 0  # rows from unlabelled frames are classified as -1
+
+    # Determine bins to compute histograms over for each feature
+    #avg = v.mean()     # Bounds are limited to 3 times the standard deviation 
+    #wid = 3.0*v.std()  #  or the max/min; whichever gives the smaller interval.
+    mn = self._feat.min(axis=0).astype(float64)
+    mx = self._feat.max(axis=0).astype(float64)
+    self._feature_bin_mins[:]       = mn
+    self._feature_bin_deltas[:]     = ( mx*(1.001) - mn )/float(nbins) # bins are uniform, so a value's bin can be computed directly
+    self._feature_bin_inv_deltas[:] = 1.0/self._feature_bin_deltas
+    ibins = self._discritize( self._feat ) # same binning as used in evaluation
+    state_col = state_col[valid]           # drop unlabelled rows once, up front
+    ibins     = ibins[valid]
+
+    # histograms for all states and features: (state,feature,bin)
+    counts = self._scratch( 'counts', (nstates,nfeat,nbins) )
+    for i in range(nfeat):
+      flat = state_col*nbins + ibins[:,i]
+      counts[:,i,:] = bincount( flat, minlength=nstates*nbins ).reshape( (nstates,nbins) )
+    counts += 1.0                       #add one to each bin...gets rid of zeros
+    a = self._scratch( 'blur', counts.shape )
+    a[:] = counts                       # a little blurring - extends distributions to cover things near what's been observed
+    a[:,:,1:]  = maximum(a[:,:,1:], counts[:,:,:-1])
+    a[:,:,:-1] = maximum(a[:,:,:-1],counts[:,:,1:])
+    a /= a.sum(axis=2)[:,:,newaxis]
+    #counts /= counts.sum()                #  FIXME: (line above) better way? what's the upper bound on the prob of a bin w 0
+    logp = log2(a).astype(float32) # all counts>0; single precision is plenty for log2 probabilities
+    for istate,state in enumerate(self._states):
+      self._distributions[state] = logp[istate]
+    self._stack_distributions()
+
+  def _stack_distributions(self):
+    """ Stacks the distributions into one (state,feature,bin) array for `_logp_table`.
+        Must be called again whenever `_distributions` is changed. """
+    names = list( self._distributions.keys() )
+    self._stacked      = array( [ self._distributions[s] for s in names ] )
+    self._stacked_rows = dict( (s,i) for i,s in enumerate(names) )
     
   def _discritize(self, fv): 
-    #FIXME: there's a problem here with out of bounds values
-    return array( [ floor((val-bmin)/db) for val,db,bmin in zip(fv, \
-                                                                self._feature_bin_deltas, \
-                                                                self._feature_bin_mins) ] )
+    """ Returns bin indices for feature vectors.  Out of range values go to the end bins. """
+    idx = floor( (fv - self._feature_bin_mins) * self._feature_bin_inv_deltas ).astype(intp)
+    return idx.clip( 0, self._nbins-1, out=idx )
+
+  def _logp(self, fv, state):
+    idx = self._discritize( fv )
+    return float( self._distributions[state][self._feature_index, idx].sum(dtype=float64) )
 
   def evaluate(self, seg, state ):
-    data = self.feature(seg)
-    idx = self._discritize( data )
-    logp = [ self._distributions[state][i][j] for i,j in enumerate(idx)]
-    return sum(logp)
+    return self._logp( self.feature(seg), state )
   
   def evaluate_by_lookup(self, fidwid, state ):
-    data = self._feature_table[ self._feature_table_index[fidwid], 3: ]
-    idx = self._discritize( data )
-    logp = [ self._distributions[state][i][j] for i,j in enumerate(idx) ]
-    return sum(logp)
+    return self._logp( self._feat[ self._feature_table_index[fidwid] ], state )
+
+  def _logp_table(self, fv, states):
+    """ Returns log2 probabilities for each state (rows) and each feature vector in `fv` (columns) """
+    idx  = self._discritize( fv )
+    rows = array( [ self._stacked_rows[s] for s in states ], dtype=intp )
+    logp = self._stacked[ rows[:,newaxis,newaxis], self._feature_index, idx ] # (state,segment,feature)
+    return ascontiguousarray( logp.sum(axis=2,dtype=float64) ) # viterbi expects doubles
+
+  def batch_evaluate(self, segs, states):
+    """ Like `evaluate` for a sequence of segments and states.  Returns a (state,segment) array. """
+    return self._logp_table( self.batch_feature(segs), states )
+
+  def batch_evaluate_by_lookup(self, fidwids, states):
+    rows = [ self._feature_table_index[k] for k in fidwids ]
+    return self._logp_table( self._feat[ rows ], states )
 
   def assign_state( self, fidwid ):
     """ Returns state, log2 probability """
-    states = self._distributions.keys()
-    logp   = array( [ self.evaluate_by_lookup(fidwid,s) for s in states ] );
+    states = list( self._distributions.keys() )
+    logp   = self.batch_evaluate_by_lookup( [fidwid], states )[:,0]
     idx = argmax(logp)
     return states[idx], logp[idx]
 
@@ -181,18 +256,20 @@ class EDTwoState(EmmissionDistributions):
 
   @staticmethod
   def _itertraj(traj):
-    for tid,v in traj.iteritems():
-      for fid,wid in v.iteritems():
+    for tid,v in traj.items():
+      for fid,wid in v.items():
         yield fid,wid
 
   @staticmethod
   def _make_classifer(traj):
-    frames = set()
-    for v in traj.values():
-      frames.update( v.keys() )
-    labelled = set( list( EDTwoState._itertraj(traj) ) )
-    def classifier(wvd,traj,wid,fid):
-      return int( (wid,fid) in labelled ) if fid in frames else -1
+    frames   = _traj_frames(traj)
+    labelled = _traj_keys(traj)
+    def classifier(wvd,traj,fid,wid):
+      c = where( _contains( frames, asarray(fid).astype(int64) ),
+                 _contains( labelled, _fidwid_key(fid,wid) ),
+                 -1 )
+      return c if ndim(c) else int(c)
+    classifier.vectorized = True
     return classifier
 
   def estimate(self, wvd, traj, data = None):
@@ -203,14 +280,42 @@ class EDTwoState(EmmissionDistributions):
 
 # def iterstates(n):
 #   yield "start"
-#   for i in xrange(n):
+#   for i in range(n):
 #     yield "junk%d"%i
 #     yield "whisker%d"%i
 #   yield "end"
 
+def _fidwid_key(fid,wid):
+  """ Packs frame and whisker id's into a single int64 key.  Works elementwise on arrays. """
+  return ( asarray(fid).astype(int64) << 32 ) | asarray(wid).astype(int64)
+
+def _traj_frames(traj):
+  """ Returns the sorted frame id's covered by any trajectory """
+  return array( sorted( {fid for v in traj.values() for fid in v} ), dtype=int64 )
+
+def _traj_keys(traj):
+  """ Returns the sorted `_fidwid_key`s of the segments labelled by any trajectory """
+  fids = fromiter( (fid for v in traj.values() for fid in v.keys()  ), dtype=int64 )
+  wids = fromiter( (wid for v in traj.values() for wid in v.values()), dtype=int64 )
+  return sort( _fidwid_key(fids,wids) )
+
+def _contains(keys, k):
+  """ Elementwise test for membership of `k` in the sorted array `keys` """
+  if len(keys)==0:
+    return zeros( shape(k), dtype=bool )
+  i = searchsorted(keys,k).clip(0,len(keys)-1)
+  return keys[i]==k
+
+def _lookup(keys, values, k, default = -1):
+  """ Maps `k` through the sorted array `keys` to the parallel array `values` """
+  if len(keys)==0:
+    return ones( shape(k), dtype=int )*default
+  i = searchsorted(keys,k).clip(0,len(keys)-1)
+  return where( keys[i]==k, values[i], default )
+
 def wcmp(a,b):
   """ A strict ordering whisker segments in a frame """
-  return cmp( a.y[0], b.y[0] )
+  return (a.y[0] > b.y[0]) - (a.y[0] < b.y[0])
 
 class EDMultiState(EmmissionDistributions):
   def __init__(self, wvd, traj, data = None, do_estimate = True):
@@ -222,8 +327,8 @@ class EDMultiState(EmmissionDistributions):
 
   @staticmethod
   def _itertraj(traj):
-    for tid,v in traj.iteritems():
-      for fid,wid in v.iteritems():
+    for tid,v in traj.items():
+      for fid,wid in v.items():
         yield fid,wid
 
   def _make_classifer(self, wvd,traj):
@@ -231,32 +336,33 @@ class EDMultiState(EmmissionDistributions):
     Generates the classifier function used in estimating distributions
     Also generates the states.
     """
-    labelled = set( list( self._itertraj(traj) ) )
-    frames = set()
-    for v in traj.values():
-      frames.update( v.keys() )
+    labelled = _traj_keys(traj)
+    frames   = _traj_frames(traj)
 
     self._nsteps = 0
 
     names = "junk%d","whisker%d"
-    wrowcmp = lambda a,b: wcmp(a[1],b[1])
-    classmap = {}
-    states   = set()
-    for fid,wv in wvd.iteritems():
-      t = 0
-      for wid,w in sorted( wv.items(), cmp = wrowcmp ):
-        if (fid,wid) in labelled: #whisker
-          name = names[1]%t
-          t+=1
-        else: #junk
-          name = names[0]%t
-        classmap[ (fid,wid) ] = name
-        states.add(name)
-      self._nsteps = max(self._nsteps,t)
-    self._states = list(states)
+    keys       = []
+    classnames = []
+    for fid,wv in wvd.items():
+      k = _fidwid_key( fid, wid_sequence_from_frame( wv ) )
+      w = _contains( labelled, k ).astype(int)  # 1 for whisker, 0 for junk
+      t = w.cumsum() - w                        # number of whiskers preceding each segment
+      keys.append(k)
+      classnames.extend( names[iw]%it for iw,it in zip(w.tolist(),t.tolist()) )
+      self._nsteps = max(self._nsteps,int(w.sum()))
+    self._states = list(set(classnames))
     statemap = dict( [(n,i) for i,n in enumerate(self._states) ] )
+    keys  = concatenate( keys ) if keys else zeros( 0, dtype=int64 )
+    ids   = array( [ statemap[n] for n in classnames ], dtype=int )
+    order = argsort( keys )
+    keys,ids = keys[order], ids[order]
     def classifier(wvd,traj,fid,wid):
-      return statemap[ classmap[(fid,wid)] ] if fid in frames else -1
+      c = where( _contains( frames, asarray(fid).astype(int64) ),
+                 _lookup( keys, ids, _fidwid_key(fid,wid) ),
+                 -1 )
+      return c if ndim(c) else int(c)
+    classifier.vectorized = True
     return classifier
 
   def estimate(self, wvd, traj, data = None):
@@ -271,20 +377,22 @@ class EDMultiState(EmmissionDistributions):
     for prefix in ['junk','whisker']:
       acc = zeros( self._distributions['junk0'].shape )
       count = 0
-      for state,dist in self._distributions.iteritems():
+      for state,dist in self._distributions.items():
         if prefix == state[:len(prefix)]:
           count += 1
           acc += (2**dist)
       assert(count>0)
-      acc = log2(acc/float(count))
+      acc = log2(acc/float(count)).astype(float32)
       for state in self._distributions.keys():
         if prefix == state[:len(prefix)]:
           self._distributions[state] =  acc.copy()
+    self._stack_distributions()
     
 class LeftRightModel(object):
   def __init__(self):
     object.__init__(self)
     self.states = None
+    self._state_index = {} # map state name -> index in states
     self._statemodel = None
     self._startprob   = {} # map dest   -> log2 prob
     self._transitions = {} # map source -> ( map destination -> log2 prob )
@@ -293,37 +401,29 @@ class LeftRightModel(object):
   def make_transition_matrix(self):
     n = len(self.states)
     T = ones( (n,n) ) * self._lowlogp 
-    for isrc,src in enumerate(self.states):
-      for idst,dst in enumerate(self.states):
-        try:
-          T[isrc,idst] = self._transitions[ src ][ dst ]
-        except KeyError:
-          pass
+    index = self._state_index
+    edges = [ (index[src],index[dst],logp) for src,row in self._transitions.items() if src in index
+                                           for dst,logp in row.items()              if dst in index ]
+    if edges:
+      isrc,idst,logp = zip(*edges)
+      T[ list(isrc), list(idst) ] = logp
     return T
 
   def make_start_matrix(self):
     n = len(self.states)
     S = ones ( n ) * self._lowlogp
-    for isrc,src in enumerate(self.states):
-      try:
-        S[isrc] = self._startprob[src]
-      except KeyError:
-        pass
+    index = self._state_index
+    starts = [ (index[dst],logp) for dst,logp in self._startprob.items() if dst in index ]
+    if starts:
+      idst,logp = zip(*starts)
+      S[ list(idst) ] = logp
     return S
 
   def make_emmissions_matrix(self, whiskers):
-    E = ones ( (len(self.states),len(whiskers)) ) * self._lowlogp
-    for istate,state in enumerate(self.states):
-      for iw,w in enumerate(whiskers):
-        E[istate,iw] = self._statemodel.evaluate(w,state)
-    return E
+    return self._statemodel.batch_evaluate( whiskers, self.states )
   
   def make_emmissions_matrix_by_lookup(self, whisker_keys):
-    E = ones ( (len(self.states),len(whisker_keys)) ) * self._lowlogp
-    for istate,state in enumerate(self.states):
-      for iw,fidwid in enumerate(whisker_keys):
-        E[istate,iw] = self._statemodel.evaluate_by_lookup(fidwid,state)
-    return E
+    return self._statemodel.batch_evaluate_by_lookup( whisker_keys, self.states )
 
   def viterbi(self, sequence):
     S = self._S
@@ -331,7 +431,7 @@ class LeftRightModel(object):
     T = self._T
     seq = array( range(len(sequence)), dtype=int32)
     p,vp,s = trace.viterbi_log2( seq, S, T, E )
-    return map( lambda i: self.states[i], s ), p, vp
+    return [ self.states[i] for i in s ], p, vp
 
   def viterbi_by_lookup(self, fid, widseq):
     S = self._S
@@ -339,12 +439,12 @@ class LeftRightModel(object):
     T = self._T
     seq = array( range(len(widseq)), dtype=int32)
     p,vp,s = trace.viterbi_log2( seq, S, T, E )
-    return map( lambda i: self.states[i], s ), p, vp
+    return [ self.states[i] for i in s ], p, vp
 
   @staticmethod
   def _itertrajinv(traj):
-    for tid,v in traj.iteritems():
-      for fid,wid in v.iteritems():
+    for tid,v in traj.items():
+      for fid,wid in v.items():
         yield (fid,wid),tid
 
   def train(self,wvd,traj, data=None):
@@ -363,23 +463,30 @@ class LeftRightModel(object):
 
     simplestates = EDTwoState( wvd, traj, do_estimate = False ) #builds the state space and classifier
     classify = simplestates._classifier
-    for fid,wv in wvd.iteritems():
-      wids = wvd.keys()
-      prev = classify(wvd,traj,fid,wids[0])
-      if prev == -1: #frame absent
-        continue
-      S[prev]+=1;
-      for wid in wids[1:]:
-        next = classify(wvd,traj,fid,wid)
-        T[prev,next] +=1;
-        prev = next;
-      E[prev]+=1;
+
+    # classify every segment at once; frames are laid end to end with
+    # segments in left-right order
+    fids,wids,sizes = [],[],[]
+    for fid,wv in wvd.items():
+      seq = wid_sequence_from_frame( wv )
+      fids.extend( [fid]*len(seq) )
+      wids.extend( seq )
+      sizes.append( len(seq) )
+    cls   = asarray( classify( wvd, traj, array(fids,dtype=int64), array(wids,dtype=int64) ), dtype=intp )
+    sizes = array( sizes, dtype=intp )
+    ends  = sizes.cumsum()[ sizes>0 ]
+    last  = zeros( len(cls), dtype=bool )
+    last[ends-1] = True
+    frame_present = cls[ends-1] != -1   # segments in absent frames are all -1
+    add.at( S, cls[ (ends-sizes[sizes>0])[frame_present] ], 1 )
+    add.at( E, cls[ (ends-1)[frame_present] ], 1 )
+    step = ~last[:-1] & (cls[:-1] != -1) # consecutive segments in the same frame
+    add.at( T, ( cls[:-1][step], cls[1:][step] ), 1 )
 
     #normalize to make stochastic matrix/vector
     S /= S.sum()
     E /= E.sum()
-    for row in T:
-      row /= row.sum()
+    T /= T.sum(axis=1)[:,newaxis]
     S,E,T = map( log2, (S,E,T) )
 
     self._simple_model = S,T,E,simplestates # just saved for debug/inspection
@@ -390,6 +497,7 @@ class LeftRightModel(object):
     lrstates = EDMultiState( wvd, traj, do_estimate = False )
     self._statemodel = lrstates
     self.states = lrstates._states
+    self._state_index = dict( (n,i) for i,n in enumerate(self.states) )
     classify = lrstates._classifier
 
     names = dict( [ (k,v+"%d") for k,v in enumerate( simplestates._states ) ] )
@@ -404,7 +512,7 @@ class LeftRightModel(object):
     #middle to end
     for src,row in enumerate(T): # no start as source state or end state
       for dst,logp in enumerate(row):
-        for time in xrange( lrstates._nsteps+1 ):
+        for time in range( lrstates._nsteps+1 ):
           if src == 0: #junk
             self._transitions.setdefault( map_state(src,time), {} )[map_state(dst,time  )] = log2(0.5) #logp
           else: #whisker
@@ -417,20 +525,21 @@ class LeftRightModel(object):
     pass
 
 def wid_sequence_from_frame( wv ):
-  wrowcmp = lambda a,b: wcmp(a[1],b[1])
-  return [wid for wid,seg in sorted( wv.items(), cmp=wrowcmp )]
+  """ Returns the whisker id's in the frame ordered as by `wcmp` """
+  wids = list( wv.keys() )
+  y0   = array( [ wv[wid].y[0] for wid in wids ] )
+  return [ wids[i] for i in argsort( y0, kind='mergesort' ) ] # stable, like sorted()
 
 def apply_model(wvd,model):
   logp = zeros( max(wvd.keys())+1 )
   vlogp = zeros( max(wvd.keys())+1 )
-  statemap = dict( [ ('whisker%d'%i,i) for i in xrange(model._statemodel._nsteps) ] ) #TODO: there's got to be a better way
+  statemap = dict( [ ('whisker%d'%i,i) for i in range(model._statemodel._nsteps) ] ) #TODO: there's got to be a better way
   traj = {}
-  wrowcmp = lambda a,b: wcmp(a[1],b[1])
-  for fid, wv in wvd.iteritems():
+  for fid, wv in wvd.items():
     #print fid
     seq = wid_sequence_from_frame( wv ) #ordered wid's
     labels,p,vp = model.viterbi_by_lookup(fid, seq )  
-    tids = map( statemap.get, labels )
+    tids = [ statemap.get(label) for label in labels ]
     logp[fid] = p
     vlogp[fid] = vp
 
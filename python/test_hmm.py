@@ -0,0 +1,254 @@
+"""
+Tests for the segment features and the hidden markov model used to
+classify whisker segments.
+"""
+import unittest
+import warnings
+from numpy import arange, linspace, float32, float64, array, allclose, errstate, hstack, zeros
+from numpy import histogram, maximum, log2, floor, clip
+from numpy.random import RandomState
+import trace
+import features
+import hmm
+
+def make_segment( fid, wid, y0, n = 40, bend = 0.01, reverse = False ):
+  """ Returns a curved Whisker_Seg starting near (10,y0) """
+  w = trace.Whisker_Seg()
+  w.time, w.id = fid, wid
+  x = 10 + 2.0*arange(n)
+  y = y0 + bend*(x-10)**2
+  if reverse:
+    x,y = x[::-1],y[::-1]
+  w.x      = x.astype(float32)
+  w.y      = y.astype(float32)
+  w.scores = linspace( 50, 100, n ).astype(float32)
+  w.thick  = ( 2 + (arange(n)%3) ).astype(float32)
+  return w
+
+class Tests_Features(unittest.TestCase):
+  def setUp(self):
+    warnings.simplefilter("ignore") #for polyfit
+    self.segs = [ make_segment( 0, i, 20.0*i, n = 30+7*i, bend = 0.005*(i-2), reverse = (i%2==1) )
+                  for i in range(5) ]
+    self.funcs = [ f for name,f in hmm.EmmissionDistributions(["junk","whisker"],None)._features ]
+
+  def tearDown(self):
+    warnings.resetwarnings()
+
+  def per_segment(self, side):
+    """ Features computed one segment at a time, as in summary.features """
+    def row(w):
+      s,dx = features.check_side(w,side)
+      return [ features.integrate_path_length(w),
+               features.median_score(w),
+               features.root_angle_deg(w,s,dx),
+               features.mean_curvature(w,s,dx),
+               features.follicle_x(w,s),
+               features.follicle_y(w,s) ]
+    return array( [ row(w) for w in self.segs ], dtype=float32 )
+
+  def check(self, side):
+    got      = features.extract_all( self.segs, self.funcs, side = side )
+    expected = self.per_segment( side )
+    self.assertEqual( got.shape, expected.shape )
+    self.assertTrue( allclose( got, expected, rtol = 1e-5, atol = 1e-6 ) )
+
+  def test_ExtractAll_MatchesPerSegment_FirstPoint(self):
+    self.check(0)
+
+  def test_ExtractAll_MatchesPerSegment_LastPoint(self):
+    self.check(-1)
+
+  def test_ExtractAll_MatchesPerSegment_SideFunction(self):
+    self.check( features.make_side_function( 0, 0 ) )
+
+  def test_FolliclePosition_FollowsSide(self):
+    side = features.make_side_function( 1000, 0 ) # face is to the right
+    feat = features.extract_all( self.segs, [features.follicle_x], side = side )
+    for w,x in zip( self.segs, feat[:,0] ):
+      self.assertEqual( x, max( w.x[0], w.x[-1] ) )
+
+  def test_BatchFeature_MatchesPerSegment(self):
+    model = hmm.EmmissionDistributions( ["junk","whisker"], None, side = -1 )
+    self.assertTrue( ( model.batch_feature(self.segs) == features.extract_all(self.segs,self.funcs,side=-1) ).all() )
+    self.assertTrue( ( model.feature(self.segs[2]) == model.batch_feature(self.segs)[2] ).all() )
+
+def make_frames():
+  """ A small hand labelled movie.
+
+  Returns a whiskers dict and a trajectories dict.  Segments are listed by
+  y position (the order used by `wid_sequence_from_frame`) with their labels:
+
+    frame 0: wid 1 (traj 0), wid 2 (junk),   wid 0 (traj 1)
+    frame 1: wid 0 (traj 0), wid 1 (junk),   wid 2 (traj 1), wid 3 (junk)
+    frame 2: wid 7 (traj 0), wid 5 (traj 1)
+    frame 3: wid 0, wid 1 -- not covered by any trajectory
+  """
+  layout = { 0: { 0:50.0, 1:10.0, 2:30.0 },
+             1: { 0: 5.0, 1:25.0, 2:45.0, 3:60.0 },
+             2: { 5:40.0, 7:20.0 },
+             3: { 0: 1.0, 1: 2.0 } }
+  wvd  = dict( ( fid, dict( (wid,make_segment(fid,wid,y0)) for wid,y0 in v.items() ) ) for fid,v in layout.items() )
+  traj = { 0: { 0:1, 1:0, 2:7 },
+           1: { 0:0, 1:2, 2:5 } }
+  return wvd,traj
+
+class Tests_Classifiers(unittest.TestCase):
+  def setUp(self):
+    self.wvd,self.traj = make_frames()
+
+  def test_WidSequence_OrderedByFirstY(self):
+    self.assertEqual( hmm.wid_sequence_from_frame( self.wvd[0] ), [1,2,0] )
+    self.assertEqual( hmm.wid_sequence_from_frame( self.wvd[1] ), [0,1,2,3] )
+    self.assertEqual( hmm.wid_sequence_from_frame( self.wvd[2] ), [7,5] )
+
+  def test_WidSequence_TiesKeepFrameOrder(self):
+    wv = dict( (wid, make_segment(0,wid,10.0)) for wid in [3,1,2] )
+    self.assertEqual( hmm.wid_sequence_from_frame( wv ), list(wv.keys()) )
+
+  def test_TwoState_Classifier(self):
+    classify = hmm.EDTwoState._make_classifer( self.traj )
+    self.assertEqual( classify( self.wvd, self.traj, 0, 1 ),  1 )
+    self.assertEqual( classify( self.wvd, self.traj, 0, 2 ),  0 )
+    self.assertEqual( classify( self.wvd, self.traj, 2, 7 ),  1 ) # wid isn't a frame id
+    self.assertEqual( classify( self.wvd, self.traj, 3, 0 ), -1 ) # wid is a frame id, but frame 3 isn't labelled
+    fids = array([ 0, 0, 0, 1, 1, 1, 1, 2, 2, 3, 3 ])
+    wids = array([ 1, 2, 0, 0, 1, 2, 3, 7, 5, 0, 1 ])
+    self.assertEqual( classify( self.wvd, self.traj, fids, wids ).tolist(),
+                      [ 1, 0, 1, 1, 0, 1, 0, 1, 1,-1,-1 ] )
+
+  def test_MultiState_Classifier(self):
+    model    = hmm.EDMultiState( self.wvd, self.traj, do_estimate = False )
+    classify = model._classifier
+    name     = lambda fid,wid: model._states[ classify(self.wvd,self.traj,fid,wid) ]
+    self.assertEqual( [ name(0,wid) for wid in [1,2,0] ],   ['whisker0','junk1','whisker1'] )
+    self.assertEqual( [ name(1,wid) for wid in [0,1,2,3] ], ['whisker0','junk1','whisker1','junk2'] )
+    self.assertEqual( [ name(2,wid) for wid in [7,5] ],     ['whisker0','whisker1'] )
+    self.assertEqual( classify( self.wvd, self.traj, 3, 0 ), -1 )
+    self.assertEqual( model._nsteps, 2 )
+
+  def test_TimeIndependent_TransitionCounts(self):
+    with errstate( divide = 'ignore' ):
+      model = hmm.LeftRightModel().train_time_independent( self.wvd, self.traj )
+    S,T,E,simplestates = model._simple_model
+    # counted by hand from `make_frames` (0: junk, 1: whisker); frame 3 is skipped
+    self.assertTrue( allclose( 2**S, array([ 0, 3 ])/3.0 ) )
+    self.assertTrue( allclose( 2**E, array([ 1, 2 ])/3.0 ) )
+    self.assertTrue( allclose( 2**T, array([[ 0, 2 ],
+                                            [ 3, 1 ]]) / array([[2.0],[4.0]]) ) )
+
+def make_training_set():
+  """ Like `make_frames` but with segments that differ in shape, so every
+  feature spreads over several bins.
+  """
+  wvd,traj = make_frames()
+  for fid,wv in wvd.items():
+    for wid,w in list(wv.items()):
+      wv[wid] = make_segment( fid, wid, w.y[0], n = 25+5*wid+3*fid, bend = 0.004*(wid-fid), reverse = ((wid+fid)%2==1) )
+  return wvd,traj
+
+def make_data(model, wvd, nextra = 2):
+  """ A table laid out like `MeasurementsTable.asarray`: class id, fid, wid,
+  the model's features and then `nextra` more measurement columns. """
+  rows = [ (fid,wid,w) for fid,wv in wvd.items() for wid,w in wv.items() ]
+  ids  = array( [ (0,fid,wid) for fid,wid,w in rows ], dtype=float64 )
+  feat = model.batch_feature( [ w for fid,wid,w in rows ] )
+  return hstack( ( ids, feat, zeros( (len(rows),nextra) ) + 7.0 ) )
+
+class Tests_Training(unittest.TestCase):
+  def setUp(self):
+    warnings.simplefilter("ignore") #for polyfit and log2(0)
+    self.wvd,self.traj = make_training_set()
+
+  def tearDown(self):
+    warnings.resetwarnings()
+
+  def test_Train_WithExtraMeasurementColumns(self):
+    expected = hmm.LeftRightModel().train( self.wvd, self.traj )
+    data     = make_data( expected._statemodel, self.wvd ) # 3 + 6 features + 2 extra columns
+    got      = hmm.LeftRightModel().train( self.wvd, self.traj, data = data )
+    self.assertEqual( got._statemodel._feat.shape[1], len(got._statemodel._features) )
+    for state in expected.states:
+      self.assertTrue( allclose( got._statemodel._distributions[state],
+                                 expected._statemodel._distributions[state] ) )
+
+  def test_Estimate_WithScalarClassifier(self):
+    frames   = set( fid for v in self.traj.values() for fid in v.keys() )
+    labelled = set( (fid,wid) for v in self.traj.values() for fid,wid in v.items() )
+    def classify(wvd,traj,fid,wid):
+      if fid not in frames:
+        return -1
+      return int( (fid,wid) in labelled ) # fails on arrays
+    got      = hmm.EmmissionDistributions( ["junk","whisker"], classify, self.wvd, self.traj )
+    expected = hmm.EDTwoState( self.wvd, self.traj )
+    self.assertEqual( got._cls.tolist(), expected._cls.tolist() )
+    for state in expected._states:
+      self.assertTrue( ( got._distributions[state] == expected._distributions[state] ).all() )
+
+  def test_Estimate_KeepsPublishedFeatures(self):
+    model = hmm.EDTwoState( self.wvd, self.traj )
+    feat  = model._feat
+    kept  = feat.copy()
+    wvd,traj = make_frames()
+    model.estimate( wvd, traj )
+    self.assertFalse( model._feat is feat )
+    self.assertTrue( ( feat == kept ).all() )
+
+class Tests_Emmissions(unittest.TestCase):
+  def setUp(self):
+    warnings.simplefilter("ignore") #for polyfit and log2(0)
+
+  def tearDown(self):
+    warnings.resetwarnings()
+
+  def reference_distribution(self, v, mask, nbins):
+    """ The histogram for one state and feature, computed as by the original per-state loop """
+    b = linspace( v.min(), v.max()*(1.001), nbins+1 )
+    counts,bb = histogram( v[mask], bins = b )
+    counts = counts.astype(float64) + 1.0
+    a = counts.copy()
+    a[1:]  = maximum(a[1:], counts[:-1])
+    a[:-1] = maximum(a[:-1],counts[1:])
+    return log2( a/a.sum() )
+
+  def test_Estimate_MatchesReferenceHistograms(self):
+    wvd  = dict( ( fid, dict( (wid,make_segment(fid,wid,10.0*wid)) for wid in range(5) ) ) for fid in range(60) )
+    traj = { 0: dict( (fid,1) for fid in range(50) ),
+             1: dict( (fid,3) for fid in range(50) ) } # frames 50-59 are unlabelled
+    model = hmm.EDTwoState( wvd, traj, do_estimate = False )
+    data  = make_data( model, wvd )
+    data[:,3:9] = RandomState(0).uniform( 1, 100, size = (len(data),6) ) # spread each feature over every bin
+    model.estimate( wvd, traj, data = data )
+    feat = data[:,3:9].astype(float32).astype(float64)
+    cls  = array( [ model._classifier(wvd,traj,int(fid),int(wid)) for fid,wid in data[:,1:3] ] )
+    for istate,state in enumerate( model._states ):
+      for i in range(6):
+        expected = self.reference_distribution( feat[:,i], cls==istate, model._nbins )
+        self.assertTrue( allclose( model._distributions[state][i], expected, atol = 1e-5 ) )
+
+  def test_BatchEvaluate_MatchesPerFrame(self):
+    wvd,traj = make_training_set()
+    model    = hmm.LeftRightModel().train( wvd, traj )
+    statemodel = model._statemodel
+    def reference(w,state):
+      fv  = statemodel.feature(w)
+      idx = floor( (fv - statemodel._feature_bin_mins) / statemodel._feature_bin_deltas )
+      idx = clip( idx, 0, statemodel._nbins-1 ).astype(int)
+      return sum( float(statemodel._distributions[state][i,j]) for i,j in enumerate(idx) )
+    for fid,wv in wvd.items():
+      seq  = hmm.wid_sequence_from_frame( wv )
+      segs = [ wv[wid] for wid in seq ]
+      E    = model.make_emmissions_matrix( segs )
+      self.assertEqual( E.shape, (len(model.states),len(segs)) )
+      self.assertTrue( allclose( E, model.make_emmissions_matrix_by_lookup( [ (fid,wid) for wid in seq ] ) ) )
+      for istate,state in enumerate( model.states ):
+        for j,w in enumerate( segs ):
+          self.assertTrue( allclose( E[istate,j], statemodel.evaluate( w, state ) ) )
+          self.assertTrue( allclose( E[istate,j], reference( w, state ) ) )
+
+if __name__=='__main__':
+  testcases = [ Tests_Features, Tests_Classifiers, Tests_Training, Tests_Emmissions ]
+  suite = unittest.TestSuite()
+  for testcase in testcases:
+    suite.addTests( unittest.defaultTestLoader.loadTestsFromTestCase(testcase) )
+  runner = unittest.TextTestRunner(verbosity=2,descriptions=1).run(suite)
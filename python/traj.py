@@ -8,47 +8,55 @@ All rights reserved.
 Use is subject to Janelia Farm Research Campus Software Copyright 1.1
 license terms (http://license.janelia.org/license/jfrc_copyright_1_1.html).
 """
+from __future__ import print_function
 import os,sys
 from ctypes import *
 from ctypes.util import find_library
 import numpy
-from numpy import zeros, double, fabs, ndarray, array
+from numpy import zeros, empty, double, fabs, ndarray, array
 import trace
-from trace import cWhisker_Seg
+from trace import cWhisker_Seg, _cstr
 
 import warnings
 
 import pdb
 
-dllpath = os.path.split(os.path.abspath(__file__))[0]
-if sys.platform == 'win32':
-  lib = os.path.join(dllpath,'whisk.dll')
-else:
-  lib = os.path.join(dllpath,'libwhisk.so')
-os.environ['PATH']+=os.pathsep + os.pathsep.join(['.','..',dllpath])
-name = find_library('whisk')
-if not name:
-  name=lib
-try:
-  ctraj = cdll.LoadLibrary( name )
-except:
-  raise ImportError("Can not load whisk or traj shared library"); 
-if ctraj._name==None:
-  raise ImportError("Can not load whisk or traj shared library");
+_P_DOUBLE = POINTER( c_double )
+_P_INT    = POINTER( c_int )
+
+def _load_library():
+  """ Loads the whisk library, declares its prototypes and loads the tracing parameters """
+  dllpath = os.path.split(os.path.abspath(__file__))[0]
+  if sys.platform == 'win32':
+    lib = os.path.join(dllpath,'whisk.dll')
+  else:
+    lib = os.path.join(dllpath,'libwhisk.so')
+  os.environ['PATH']+=os.pathsep + os.pathsep.join(['.','..',dllpath])
+  name = find_library('whisk')
+  if not name:
+    name=lib
+  try:
+    ctraj = cdll.LoadLibrary( name )
+  except:
+    raise ImportError("Can not load whisk or traj shared library"); 
+  if ctraj._name==None:
+    raise ImportError("Can not load whisk or traj shared library");
+  _declare_prototypes(ctraj)
+  if ctraj.Load_Params_File(_cstr(_param_file))==1: #returns 0 on success, 1 on failure
+    raise Exception("Could not load tracing parameters from file: %s"%_param_file)
+  return ctraj
 
 _param_file = "default.parameters"
-if ctraj.Load_Params_File(_param_file)==1: #returns 0 on success, 1 on failure
-  raise Exception("Could not load tracing parameters from file: %s"%_param_file)
 
 class cMeasurements(Structure):
   """ Proxy for Measurements struct. 
   >>> from numpy.random import rand
   >>> data = rand(20,10)
-  >>> table = ctraj.Measurements_Table_From_Doubles( data.ctypes.data_as(POINTER(c_double)), 20, 10 )
+  >>> table = ctraj.Measurements_Table_From_Doubles( data.ctypes.data, 20, 10 )
   >>> table[0].n
   7
   >>> table   # doctest:+ELLIPSIS
-  <ctypes.LP_cMeasurements object at ...>
+  <...LP_cMeasurements object at ...>
   """
   _fields_ = [("row",            c_int               ),
               ("fid",            c_int               ),                                                           
@@ -61,32 +69,55 @@ class cMeasurements(Structure):
               ("valid_velocity", c_int               ),                                                           
               ("n",              c_int               ),                                                           
               ("face_axis",      c_char              ),
-              ("data",           POINTER( c_double ) ),             # // array of n elements                      
-              ("velocity",       POINTER( c_double ) )]             # // array of n elements - change in data/time
+              ("data",           _P_DOUBLE ),                       # // array of n elements                      
+              ("velocity",       _P_DOUBLE )]                       # // array of n elements - change in data/time
 
 
 class cDistributions(Structure):
   """
   >>> this = ctraj.Alloc_Distributions( 32, 8, 4 )
   >>> this                                          # doctest:+ELLIPSIS 
-  <ctypes.LP_cDistributions object at ...>
+  <...LP_cDistributions object at ...>
   >>> ctraj.Free_Distributions( this )
   """
   _fields_ = [("n_measures",   c_int               ),
               ("n_states",     c_int               ),
               ("n_bins",       c_int               ),
-              ("bin_min",      POINTER( c_double ) ),   # // array of n_measures elements                                                          
-              ("bin_delta",    POINTER( c_double ) ),   # // array of n_measures elements                                                          
-              ("data",         POINTER( c_double ) )]   # // array of holding histogram information with dimensions (n_bins,n_measures,n_states)
-  def asarray(self):
-    d = zeros( (self.n_states, self.n_measures, self.n_bins) )
-    ctraj.Copy_Distribution_To_Doubles( byref(self), d.ctypes.data_as( POINTER(c_double) ) )
+              ("bin_min",      _P_DOUBLE ),             # // array of n_measures elements                                                          
+              ("bin_delta",    _P_DOUBLE ),             # // array of n_measures elements                                                          
+              ("data",         _P_DOUBLE )]             # // array of holding histogram information with dimensions (n_bins,n_measures,n_states)
+  def asarray(self, owner):
+    """ 
+    Returns a read-only (n_states, n_measures, n_bins) view of the histogram data.
+    No copy is made.  The view refers to memory owned by the C library, so
+    `owner` must be the object that frees this struct (the `Distributions`
+    holding it).  The view keeps `owner` alive for as long as it exists.
+    Use `Distributions.shapes` or `Distributions.velocities` rather than
+    calling this directly.
+    """
+    shape = (self.n_states, self.n_measures, self.n_bins)
+    buf = (c_double * (shape[0]*shape[1]*shape[2])).from_address( addressof(self.data.contents) )
+    buf._owner = owner
+    d = ndarray( shape, dtype=double, buffer=buf )
+    d.flags.writeable = False
     return d
   
   def bins_as_array(self):
-    b = zeros( (self.n_measures, self.n_bins) )
-    ctraj.Distributions_Bins_To_Doubles( byref(self), b.ctypes.data_as( POINTER(c_double) ) )
-    return b
+    """ Returns the (n_measures, n_bins) array of bin positions, computed from bin_min and bin_delta. """
+    mn    = array( self.bin_min  [:self.n_measures] )[:,numpy.newaxis]
+    delta = array( self.bin_delta[:self.n_measures] )[:,numpy.newaxis]
+    return mn + numpy.arange( self.n_bins ) * delta
+
+class _SharedStorage(object):
+  """ Owns a table's storage once views of it have been handed out.  The
+  storage is freed when the table and all of the views are gone.
+  """
+  def __init__(self, measurements, free):
+    self._measurements = measurements
+    self._free = free
+
+  def __del__(self):
+    self._free( self._measurements )
 
 class MeasurementsTable(object):
   """
@@ -111,7 +142,10 @@ class MeasurementsTable(object):
     object.__init__(self)
     self._measurements = None
     self._nrows = 0
+    self._ncols = 0        # number of measurements per row
     self._sort_state = None
+    self._state_sizes = {} # state -> number of rows, see `_size_select_state`
+    self._shared = None    # owns the storage once views are out, see `_storage_views`
     self._free_measurements = ctraj.Free_Measurements_Table
     if isinstance(datasource,str):
       self._load(datasource)
@@ -120,21 +154,31 @@ class MeasurementsTable(object):
       facehint = datasource['facehint']
       self._measurements, self._nrows = MeasurementsTable._fromWhiskerDictWithFacehint( wvd, facehint )
     else:
+      datasource = numpy.ascontiguousarray( datasource, dtype=double ) # C reads rows of doubles; copies only if needed
       self._measurements = ctraj.Measurements_Table_From_Doubles( 
-                              datasource.ctypes.data_as( POINTER(c_double) ),   # data buffer       
+                              datasource.ctypes.data,                           # data buffer       
                               datasource.shape[0],                              # number of rows    
                               datasource.shape[1] )                             # number of columns 
       self._nrows = datasource.shape[0]
+    self._ncols = self._measurements[0].n if self._nrows else 0
 
   def __del__(self):
     """
     >>> table = MeasurementsTable( zeros((500,5)) )
     >>> del table
     """
-    self._free_measurements(self._measurements)
+    self._release()
+
+  def _release(self):
+    """ Frees the table's storage, or leaves it to outstanding views from `_storage_views` """
+    if getattr(self, '_shared', None):
+      self._shared = None
+    elif getattr(self, '_measurements', None): # construction may have failed part way
+      self._free_measurements(self._measurements)
+    self._measurements = None
 
   @staticmethod
-  def _fromWhiskerDict(wvd, (facex,facey), faceaxis ):
+  def _fromWhiskerDict(wvd, face, faceaxis ):
     """
     Returns: LP_cMeasurements, int
       
@@ -142,6 +186,7 @@ class MeasurementsTable(object):
              when finished.  Potential memory leak.  For this reason, use the 
              MeasurementsTable constructor (__init__) instead.
     """
+    facex,facey = face
     wv = trace.cWhisker_Seg.CastDictToArray(wvd)
     return ctraj.Whisker_Segments_Measure(wv,len(wv), facex, facey, faceaxis), len(wv)
   
@@ -156,7 +201,7 @@ class MeasurementsTable(object):
     """
     x,y,ax = c_int(),c_int(),c_char()
     wv = trace.cWhisker_Seg.CastDictToArray(wvd)
-    ctraj.face_point_from_hint( wv, len(wv), facehint, byref(x), byref(y), byref(ax))
+    ctraj.face_point_from_hint( wv, len(wv), _cstr(facehint), byref(x), byref(y), byref(ax))
     return ctraj.Whisker_Segments_Measure(wv,len(wv), x.value, y.value, ax.value), len(wv)
 
 
@@ -166,17 +211,17 @@ class MeasurementsTable(object):
     >>> data = rand(200,10)
     >>> table = MeasurementsTable(data)
     >>> shape = table.asarray()
-    >>> print shape.shape
+    >>> print(shape.shape)
     (200, 10)
-    >>> print (shape[:,3:]==data[:,3:]).all()
+    >>> print((shape[:,3:]==data[:,3:]).all())
     True
     """
     if self._nrows==0:
       return []
-    data = zeros( (self._nrows, self._measurements[0].n+3), dtype=double )
+    data = empty( (self._nrows, self._ncols+3), dtype=double ) # every element is written
     ctraj.Measurements_Table_Data_To_Doubles(self._measurements, 
                                              self._nrows, 
-                                             data.ctypes.data_as( POINTER( c_double ))
+                                             data.ctypes.data
                                             );
     return data
 
@@ -186,15 +231,15 @@ class MeasurementsTable(object):
     >>> traj  = table.get_trajectories()
     >>> max(traj.keys())
     3
-    >>> traj.has_key(-1)
+    >>> -1 in traj
     False
     """
     data = self.asarray()
     t = {}
     for row in data:
-      r = map(int,row[:3])
+      r = [ int(x) for x in row[:3] ]
       t.setdefault( r[0],{} ).setdefault( r[1], r[2] ) 
-    if -1 in t.keys():
+    if -1 in t:
       del t[-1]
     return t
 
@@ -207,10 +252,10 @@ class MeasurementsTable(object):
     """
     trajectories = self.get_trajectories()
     f = open( filename, 'w' )
-    for k,v in trajectories.iteritems():
+    for k,v in trajectories.items():
       if not k in excludes:
-        for s,t in v.iteritems():
-          print >> f, '%d,%d,%d'%(k,s,t)
+        for s,t in v.items():
+          f.write( '%d,%d,%d\n'%(k,s,t) )
     return self
 
   def load_trajectories(self,filename ):
@@ -248,19 +293,21 @@ class MeasurementsTable(object):
     >>> lentraj = lambda x: len(table.get_shape_data(x))
     >>> lentraj(0)
     2
-    >>> add = lambda a,b:a+b
-    >>> table._nrows == reduce(add, map(lentraj,xrange(mn-1,mx+1)))
+    >>> table._nrows == sum( lentraj(s) for s in range(mn-1,mx+1) )
     True
     """
     inv = {}
-    for tid,t in traj.iteritems():
-      for k in t.iteritems():
+    for tid,t in traj.items():
+      for k in t.items():
         inv[k] = tid  
 
-    for i in xrange(self._nrows):  #update new
+    for i in range(self._nrows):  #update new
       row = self._measurements[i]
       s = inv.get( (row.fid,row.wid) )
       row.state = s if (not s is None) else -1 
+    self._state_sizes.clear()
+    if (not self._sort_state is None) and ("state" in self._sort_state):
+      self._sort_state = None # the rows are no longer grouped by state
 
     return self
 
@@ -282,13 +329,13 @@ class MeasurementsTable(object):
                               byref(mn),
                               byref(mx))
     f = lambda x: x.value if x.value >=0 else 0
-    return map(f,[mn,mx])
+    return [ f(mn), f(mx) ]
 
   def iter_state(self):
     """
     >>> table = MeasurementsTable( "data/testing/seq140[autotraj].measurements" )
     >>> for i in table.update_velocities().iter_state():
-    ...     print i
+    ...     print(i)
     ...     
     0
     1
@@ -296,7 +343,7 @@ class MeasurementsTable(object):
     3
     """
     mn,mx = self.get_state_range()
-    return xrange(mn,mx+1)
+    return range(mn,mx+1)
 
   def get_shape_table(self):
     """  
@@ -304,12 +351,29 @@ class MeasurementsTable(object):
     >>> data = rand(200,10)
     >>> table = MeasurementsTable(data)
     >>> shape = table.get_shape_table()
+    >>> shape.flags.writeable
+    False
+
+    Returns a read-only (rows,columns) view of the table's shape data, not a
+    copy.  Rows are in storage order, which sorting doesn't change.  The view
+    tracks later changes to the table; use `.copy()` for a snapshot or to get
+    a writeable array.
     """
-    shape = zeros( (self._nrows, self._measurements[0].n), dtype=double )
-    ctraj.Measurements_Table_Copy_Shape_Data( self._measurements, 
-                                              self._nrows, 
-                                              shape.ctypes.data_as( POINTER(c_double) ) )
-    return shape
+    return self._storage_views()[0]
+
+  def _size_select_state(self, state):
+    """ Returns the number of rows labelled with `state`.
+    Memoized; the cache is cleared whenever the state labels change.
+    """
+    state = int(state)
+    rows = self._state_sizes.get(state)
+    if rows is None:
+      if (not self._sort_state is None) and ("state" in self._sort_state):
+        rows = ctraj.Measurements_Table_Size_Select_State_Sorted( self._measurements, self._nrows, state )
+      else:
+        rows = ctraj.Measurements_Table_Size_Select_State( self._measurements, self._nrows, state )
+      self._state_sizes[state] = rows
+    return rows
 
   def get_time_and_mask(self, state, rows = None):
     """
@@ -320,15 +384,16 @@ class MeasurementsTable(object):
     >>> table = MeasurementsTable(data).update_velocities()
     >>> time,mask = table.get_time_and_mask(1)
     """
+    alloc = empty if rows is None else zeros # a caller-supplied size may exceed the selection, so pad with zeros
     if rows is None:
-      rows = ctraj.Measurements_Table_Size_Select_State( self._measurements, self._nrows, int(state) )
-    time = zeros( rows, dtype = double )
-    mask = zeros( rows, dtype = int    )
+      rows = self._size_select_state( state )
+    time = alloc( rows, dtype = double )
+    mask = alloc( rows, dtype = numpy.intc )
     ctraj.Measurements_Table_Select_Time_And_Mask_By_State( self._measurements, 
                                                             self._nrows,
                                                             int(state),
-                                                            time.ctypes.data_as (POINTER( c_double )), 
-                                                            mask.ctypes.data_as (POINTER( c_int    )) )
+                                                            time.ctypes.data, 
+                                                            mask.ctypes.data )
     return time,mask
 
   def get_velocities(self, state, rows = None):
@@ -342,13 +407,14 @@ class MeasurementsTable(object):
     <...MeasurementsTable object at ...>
     >>> velocities = table.get_velocities(1)
     """
+    alloc = empty if rows is None else zeros
     if rows is None:
-      rows = ctraj.Measurements_Table_Size_Select_State( self._measurements, self._nrows, int(state) )
-    vel  = zeros( (rows, self._measurements[0].n ), dtype = double )
+      rows = self._size_select_state( state )
+    vel  = alloc( (rows, self._ncols ), dtype = double )
     ctraj.Measurements_Table_Select_Velocities_By_State( self._measurements, 
                                                          self._nrows,
                                                          int(state),
-                                                         vel.ctypes.data_as (POINTER( c_double )) )
+                                                         vel.ctypes.data )
     return vel
   
   def get_shape_data(self, state, rows = None):
@@ -363,13 +429,14 @@ class MeasurementsTable(object):
     >>> table = MeasurementsTable('data/testing/seq140[autotraj].measurements').update_velocities()
     >>> shape = table.get_shape_data(1)
     """
+    alloc = empty if rows is None else zeros
     if rows is None:
-      rows = ctraj.Measurements_Table_Size_Select_State( self._measurements, self._nrows, int(state) )
-    data  = zeros( (rows, self._measurements[0].n ), dtype = double )
+      rows = self._size_select_state( state )
+    data  = alloc( (rows, self._ncols ), dtype = double )
     ctraj.Measurements_Table_Select_Shape_By_State( self._measurements, 
                                                     self._nrows,
                                                     int(state),
-                                                    data.ctypes.data_as (POINTER( c_double )) )
+                                                    data.ctypes.data )
     return data
 
   def get_data(self, state, rows = None ):
@@ -381,25 +448,95 @@ class MeasurementsTable(object):
     >>> table = MeasurementsTable(data).update_velocities()
     >>> time,shp,vel,mask = table.get_data(1)
     """
+    alloc = empty if rows is None else zeros
     if rows is None:
-      time,mask = self.get_time_and_mask(state) 
-    else:
-      time,mask = self.get_time_and_mask(state, rows = rows) 
-    vel = self.get_velocities(state, rows = time.shape[0] )
-    shp = self.get_shape_data(state, rows = time.shape[0] )
+      rows = self._size_select_state( state )
+    n    = self._ncols
+    time = alloc( rows, dtype = double )
+    mask = alloc( rows, dtype = numpy.intc )
+    shp  = alloc( (rows, n), dtype = double )
+    vel  = alloc( (rows, n), dtype = double )
+    ctraj.Measurements_Table_Select_All_By_State( self._measurements, 
+                                                  self._nrows,
+                                                  int(state),
+                                                  time.ctypes.data, 
+                                                  mask.ctypes.data, 
+                                                  shp.ctypes.data, 
+                                                  vel.ctypes.data )
     return time, shp, vel, mask
 
+  def select_all_states(self):
+    """
+    Returns offsets, time, valid velocity mask, shape and velocity data for
+    every state at once.  Rows labelled with state `s` are rows
+    offsets[s]:offsets[s+1] of the other arrays.  Rows with a negative state
+    are left out.  Within a state, order is determined by the table's sort order.
+
+    >>> data = numpy.load('data/testing/seq140[autotraj].npy')
+    >>> table = MeasurementsTable(data).update_velocities()
+    >>> offsets,time,mask,shp,vel = table.select_all_states()
+    >>> bool( (shp[offsets[1]:offsets[2]] == table.get_shape_data(1)).all() )
+    True
+    """
+    mn,mx = self.get_state_range()
+    counts  = zeros( mx+1, dtype = numpy.intc )
+    ctraj.Measurements_Table_State_Histogram( self._measurements, self._nrows, 
+                                              counts.ctypes.data, len(counts) )
+    offsets = zeros( len(counts)+1, dtype = numpy.intc )
+    numpy.cumsum( counts, out = offsets[1:] )
+    rows = int(offsets[-1])
+    n    = self._ncols
+    time = empty( rows, dtype = double )
+    mask = empty( rows, dtype = numpy.intc )
+    shp  = empty( (rows, n), dtype = double )
+    vel  = empty( (rows, n), dtype = double )
+    ctraj.Measurements_Table_Select_All_States( self._measurements, 
+                                                self._nrows,
+                                                len(counts),
+                                                offsets.ctypes.data,
+                                                time.ctypes.data, 
+                                                mask.ctypes.data, 
+                                                shp.ctypes.data, 
+                                                vel.ctypes.data )
+    return offsets, time, mask, shp, vel
+
   def get_velocities_table(self):
     """
     >>> data = numpy.load('data/testing/seq140[autotraj].npy')
     >>> table = MeasurementsTable(data).update_velocities()
     >>> vel = table.get_velocities_table()
+
+    Returns a read-only (rows,columns) view of the table's velocities, not a
+    copy.  Rows are in storage order, which sorting doesn't change.  The view
+    tracks later changes to the table, so its values change on
+    `update_velocities`; use `.copy()` for a snapshot or to get a writeable
+    array.
     """
-    vel = zeros( (self._nrows, self._measurements[0].n), dtype=double )
-    ctraj.Measurements_Table_Copy_Velocities( self._measurements, 
-                                              self._nrows, 
-                                              vel.ctypes.data_as( POINTER(c_double) ) )
-    return vel
+    return self._storage_views()[1]
+
+  def _storage_views(self):
+    """
+    Returns zero-copy, read-only (rows,columns) views of the shape data and
+    velocity blocks.  Rows are in storage order, the same order given by
+    Measurements_Table_Copy_Shape_Data/Measurements_Table_Copy_Velocities.
+
+    The views share ownership of the storage with the table (`_shared`), so
+    it stays valid until the table and the views are all gone.  Views taken
+    before a `_load` keep the old contents.
+    """
+    vel, stride, ncols = c_void_p(), c_int(), c_int()
+    shp = ctraj.Measurements_Table_Data_Base_And_Stride( self._measurements, self._nrows, 
+                                                         byref(vel), byref(stride), byref(ncols) )
+    if self._shared is None:
+      self._shared = _SharedStorage( self._measurements, self._free_measurements )
+    def view(address):
+      buf = (c_double * (self._nrows*ncols.value)).from_address(address)
+      buf._owner = self._shared
+      a = ndarray( (self._nrows, ncols.value), dtype=double, buffer=buf, 
+                   strides=(stride.value, sizeof(c_double)) )
+      a.flags.writeable = False
+      return a
+    return view(shp), view(vel.value)
 
   def set_constant_face_position(self, x, y):
     """
@@ -500,7 +637,7 @@ class MeasurementsTable(object):
     >>> table.save( "data/testing/trash.measurements" )    # doctest:+ELLIPSIS 
     <...MeasurementsTable object at ...>
     """
-    ctraj.Measurements_Table_To_Filename( filename, None, self._measurements, self._nrows )
+    ctraj.Measurements_Table_To_Filename( _cstr(filename), None, self._measurements, self._nrows )
     return self
 
   def save_to_matlab_file(self, filename, format = '5'):
@@ -532,11 +669,12 @@ class MeasurementsTable(object):
     if not os.path.exists(filename):
       raise IOError("Could not find file %s"%filename)
     nrows = c_int()
-    if self._measurements:
-      ctraj.Free_Measurements_Table( self._measurements )
-    self._measurements = ctraj.Measurements_Table_From_Filename( filename, None, byref(nrows) )
+    self._release()
+    self._measurements = ctraj.Measurements_Table_From_Filename( _cstr(filename), None, byref(nrows) )
     self._nrows = nrows.value
+    self._ncols = self._measurements[0].n if self._nrows else 0
     self._sort_state = None #unknown
+    self._state_sizes.clear()
     return self
   
   def diff_identity(self, table):
@@ -565,7 +703,7 @@ class MeasurementsTable(object):
     frames = ctraj.Measurements_Tables_Get_Diff_Frames( self._measurements, self._nrows, 
                                                         table._measurements, table._nrows, 
                                                         byref(nframes) )
-    return [frames[i] for i in xrange(nframes.value)]
+    return [frames[i] for i in range(nframes.value)]
 
   def est_length_threshold(self,lowpx=1.0/0.04,highpx=50.0/0.04):
     ncount = c_int(0)
@@ -604,10 +742,11 @@ class Distributions(object):
       self.build(table, nbins)  
   
   def __del__(self):
-    if self._shp:
-      self._free_distributions( self._shp )
-    if self._vel:
-      self._free_distributions( self._vel )
+    for name in ('_shp','_vel'):
+      d = getattr(self, name, None) # construction may have failed part way
+      if d:
+        self._free_distributions( d )
+        setattr(self, name, None)
   
   def build(self, table, nbins = 32):
     """
@@ -633,27 +772,32 @@ class Distributions(object):
     >>> dists = Distributions( MeasurementsTable('data/testing/seq140[autotraj].measurements') )
     >>> vbins, v = dists.velocities()
     """
-    return self._vel[0].bins_as_array(), self._vel[0].asarray()  
+    return self._vel[0].bins_as_array(), self._vel[0].asarray(self)
   
   def shapes(self):
     """
     >>> dists = Distributions( MeasurementsTable('data/testing/seq140[autotraj].measurements') )
     >>> sbins, s = dists.shapes()
     """
-    return self._shp[0].bins_as_array(), self._shp[0].asarray()  
+    return self._shp[0].bins_as_array(), self._shp[0].asarray(self)
 
-def solve( table ):
-  ctraj.Solve( table._measurements, table._nrows, 32, 8096 )
+def solve( table, n_shape_bins = 32, n_vel_bins = 8096 ):
+  """
+  Labels segments in frames missing from each trajectory by finding the most
+  likely path through the table.  Changes the table's sort order to time.
+
+  Scoring happens entirely in the C library (`Find_Path` evaluating the shape
+  and velocity distributions), so no Python code runs inside the search.
+  """
+  ctraj.Solve( table._measurements, table._nrows, n_shape_bins, n_vel_bins )
   table._sort_state = "time"
+  table._state_sizes.clear() # states were relabelled
   return table
 
-def batch_make_measurements(sourcepath, ext = '*.seq', label = 'curated'):
-  """
-  To update/remake a measurements table, delete the *.npy and *.measurements
-  files in the `sourcepath`.
-  """
+def _make_measurements( job ):
+  """ Makes the measurements table for one movie.  See `batch_make_measurements`. """
+  name, label = job
   warnings.simplefilter("ignore")
-  from glob import glob
   from ui.whiskerdata import load_trajectories
   from trace import Load_Whiskers
   import summary
@@ -668,16 +812,39 @@ def batch_make_measurements(sourcepath, ext = '*.seq', label = 'curated'):
       return data
     return summary.commit_traj_to_data_table( trajectories, data )
 
-  for name in glob( os.path.join( sourcepath, ext ) ):
-    root,ext = os.path.splitext( name )
-    prefix = root + '[%s]'%label
-    if not os.path.exists( prefix + '.measurements' ):
-      t,tid = load_trajectories( prefix + '.trajectories' )
-      print prefix
-      print t.keys()
-      w = Load_Whiskers( prefix + '.whiskers' ) 
-      data = get_summary_data( prefix + '.npy', w, t )
-      MeasurementsTable( data ).update_velocities().save( prefix + '.measurements' )
+  root,ext = os.path.splitext( name )
+  prefix = root + '[%s]'%label
+  if not os.path.exists( prefix + '.measurements' ):
+    t,tid = load_trajectories( prefix + '.trajectories' )
+    print(prefix)
+    print(list(t.keys()))
+    w = Load_Whiskers( prefix + '.whiskers' ) 
+    data = get_summary_data( prefix + '.npy', w, t )
+    MeasurementsTable( data ).update_velocities().save( prefix + '.measurements' )
+  return prefix
+
+def batch_make_measurements(sourcepath, ext = '*.seq', label = 'curated', nproc = 1):
+  """
+  To update/remake a measurements table, delete the *.npy and *.measurements
+  files in the `sourcepath`.
+
+  By default movies are processed one at a time in this process.  Movies are
+  independent, so passing `nproc` > 1 processes them in parallel with a pool
+  of that many worker processes (nproc=None uses the cpu count).
+  """
+  from glob import glob
+  jobs = [ (name,label) for name in glob( os.path.join( sourcepath, ext ) ) ]
+  if nproc == 1:
+    for job in jobs:
+      _make_measurements( job )
+  else:
+    from multiprocessing import Pool
+    P = Pool( processes = nproc )
+    try:
+      P.map( _make_measurements, jobs )
+    finally:
+      P.close()
+      P.join()
 
 #
 # Testing
@@ -693,44 +860,57 @@ class Tests_MeasurementsTable(unittest.TestCase):
   This test case is subclassed to handle different setups.
   """
   def test_LoadedDataValid(self):
-    self.failUnless( self.data[:,0].min() == -1 )
-    self.failUnless( self.data[:,0].max() > 1   )
+    self.assertTrue( self.data[:,0].min() == -1 )
+    self.assertTrue( self.data[:,0].max() > 1   )
 
   def test_TableInstanced(self):
-    self.failUnlessEqual( self.table._nrows, self.data.shape[0] ) 
-    self.failUnlessEqual( self.table._measurements[0].n, self.data.shape[1]-3 )
+    self.assertEqual( self.table._nrows, self.data.shape[0] ) 
+    self.assertEqual( self.table._measurements[0].n, self.data.shape[1]-3 )
 
   def test_GetShapeMeasures(self):
     shape = self.table.get_shape_table()
-    self.failUnlessEqual( shape.shape[0], self.data.shape[0] )
-    self.failUnlessEqual( shape.shape[1], self.data.shape[1]-3 )
-    #self.failUnlessAlmostEqual( ((self.data[:,3:] - shape)**2).sum(), 0.0, 7 ) #can't fix right now...not important...
+    self.assertEqual( shape.shape[0], self.data.shape[0] )
+    self.assertEqual( shape.shape[1], self.data.shape[1]-3 )
+    #self.assertAlmostEqual( ((self.data[:,3:] - shape)**2).sum(), 0.0, 7 ) #can't fix right now...not important...
+
+  def test_StorageViews_AreReadOnlyAndOutliveTable(self):
+    shape = self.table.get_shape_table()
+    self.assertRaises( ValueError, shape.__setitem__, (0,0), 1.0 )
+    expected = shape.copy()
+    self.table._load('data/testing/seq140[autotraj].measurements') # replaces the storage
+    del self.table
+    self.assertTrue( (shape == expected).all() )
 
   def test_SortByStateAndTime(self):
     self.table.sort_by_state_time()
-    for i in xrange(1, self.table._nrows):
-        self.failIf( (self.table._measurements[i-1].state > self.table._measurements[i].state) and 
-                     (self.table._measurements[i-1].fid   > self.table._measurements[i].fid) )
-    for i in xrange(1, self.table._nrows):
-        self.failIf( self.table._measurements[i-1].state  > self.table._measurements[i].state )
+    self.assertTrue( ctraj.Measurements_Table_Is_Sorted_By_State_Time( self.table._measurements, self.table._nrows ) )
+    data  = self.table.asarray()                   # checked independently of the C comparator
+    state = numpy.diff( data[:,0] )
+    self.assertTrue( ( state >= 0 ).all() )
+    self.assertTrue( ( numpy.diff( data[:,1] )[ state==0 ] >= 0 ).all() ) # time order within each state
   
   def test_SortByTime(self):
     self.table.sort_by_time()
-    for i in xrange(1, self.table._nrows):
-        self.failIf( self.table._measurements[i-1].fid  > self.table._measurements[i].fid )
+    self.assertTrue( ctraj.Measurements_Table_Is_Sorted_By_Time( self.table._measurements, self.table._nrows ) )
+    self.assertTrue( ( numpy.diff( self.table.asarray()[:,1] ) >= 0 ).all() )
 
   def test_ComputeVelocities_SomeVelocitiesAreValid(self):
     self.table.update_velocities()    
-    any = lambda x,y: x or y  
-    is_row_valid = lambda i: self.table._measurements[i].valid_velocity                                           
-    self.failUnless( reduce( any, map( is_row_valid, xrange(self.table._nrows) )) )
+    self.assertTrue( ctraj.Measurements_Table_Any_Valid_Velocity( self.table._measurements, self.table._nrows ) )
 
   def test_SizeSelectVelocities_StatesPartitionTable(self):
     self.table.update_velocities()
-    cnt = 0
-    for state in map(int, set(self.data[:,0])):
-      cnt += ctraj.Measurements_Table_Size_Select_State( self.table._measurements, self.table._nrows, c_int(state) )
-    self.failUnlessEqual( cnt, self.data.shape[0] )
+    hist  = zeros( int(self.data[:,0].max())+1, dtype=numpy.intc )
+    other = ctraj.Measurements_Table_State_Histogram( self.table._measurements, self.table._nrows, 
+                                                      hist.ctypes.data, len(hist) )
+    self.assertEqual( hist.sum() + other, self.data.shape[0] )
+
+  def test_SizeSelectState_SortedMatchesScan(self):
+    self.table.update_velocities().sort_by_state_time()
+    for s in [-1] + list(self.table.iter_state()):
+      self.assertEqual( 
+        ctraj.Measurements_Table_Size_Select_State_Sorted( self.table._measurements, self.table._nrows, s ),
+        ctraj.Measurements_Table_Size_Select_State       ( self.table._measurements, self.table._nrows, s ) )
 
   def test_SelectDataByState(self):
     """
@@ -745,10 +925,19 @@ class Tests_MeasurementsTable(unittest.TestCase):
       vel = self.table.get_velocities(s, rows = time.shape[0] )
       shp = self.table.get_shape_data(s, rows = time.shape[0] )
   
+  def test_SelectAllStates_MatchesSelectByState(self):
+    self.table.update_velocities()
+    offsets,time,mask,shp,vel = self.table.select_all_states()
+    for s in self.table.iter_state():
+      t,sh,v,m = self.table.get_data(s)
+      block = slice( offsets[s], offsets[s+1] )
+      self.assertTrue( (time[block]==t).all() and (mask[block]==m).all() )
+      self.assertTrue( (shp[block]==sh).all() and (vel[block]==v).all() )
+  
   def test_LoadNonexistentFile(self):
     filename = 'nonexistent.measurement'
-    self.failIf( os.path.exists(filename) )
-    self.failUnlessRaises(IOError, MeasurementsTable, filename)
+    self.assertFalse( os.path.exists(filename) )
+    self.assertRaises(IOError, MeasurementsTable, filename)
 
 class Tests_MeasurementsTable_FromDoubles( Tests_MeasurementsTable ):
   def setUp(self):
@@ -757,7 +946,17 @@ class Tests_MeasurementsTable_FromDoubles( Tests_MeasurementsTable ):
   
   def test_VelocitiesInitiallyZero(self):
     vel = self.table.get_velocities_table()
-    self.failUnlessAlmostEqual( vel.sum(), 0.0)
+    self.assertAlmostEqual( vel.sum(), 0.0)
+
+  def test_FromDoubles_FortranOrderedSource(self):
+    table = MeasurementsTable( numpy.asfortranarray(self.data) )
+    self.assertTrue( ( table.asarray() == self.table.asarray() ).all() )
+
+  def test_FromDoubles_SinglePrecisionSource(self):
+    data  = self.data.astype(numpy.float32)
+    table = MeasurementsTable( data )
+    self.assertTrue( ( table.asarray() == MeasurementsTable( data.astype(double) ).asarray() ).all() )
+    self.assertTrue( ( table.asarray()[:,3:] == data[:,3:] ).all() )
 
 
 class Tests_MeasurementsTable_FromFile( Tests_MeasurementsTable ):
@@ -772,142 +971,350 @@ class Tests_Distributions(unittest.TestCase):
     self.dists = Distributions(self.table)
 
   def test_PostBuildSortStateIsTime(self):
-    self.failUnlessEqual( self.table._sort_state, 'time' )
+    self.assertEqual( self.table._sort_state, 'time' )
 
   def test_InitializationTypeCheck(self):
-    self.failUnlessRaises( AssertionError, Distributions, zeros(10) )
+    self.assertRaises( AssertionError, Distributions, zeros(10) )
 
   def test_ShapeDistributionsAsArray(self):
-    d = self.dists._shp[0].asarray()
-    self.failUnless( isinstance( d, numpy.ndarray) )
+    sbins, d = self.dists.shapes()
+    self.assertTrue( isinstance( d, numpy.ndarray) )
     nstates, nmeasures, nbins = d.shape
-    self.failUnlessEqual( nstates,   self.dists._shp[0].n_states )
-    self.failUnlessEqual( nmeasures, self.dists._shp[0].n_measures )
-    self.failUnlessEqual( nbins,     self.dists._shp[0].n_bins )
+    self.assertEqual( nstates,   self.dists._shp[0].n_states )
+    self.assertEqual( nmeasures, self.dists._shp[0].n_measures )
+    self.assertEqual( nbins,     self.dists._shp[0].n_bins )
 
   def test_ShapeDistributionBinsAsArray(self):
     bins = self.dists._shp[0].bins_as_array()
-    self.failUnless( isinstance( bins, numpy.ndarray) )
+    self.assertTrue( isinstance( bins, numpy.ndarray) )
     nmeasures, nbins = bins.shape
-    self.failUnlessEqual( nmeasures, self.dists._shp[0].n_measures )
-    self.failUnlessEqual( nbins,     self.dists._shp[0].n_bins )
+    self.assertEqual( nmeasures, self.dists._shp[0].n_measures )
+    self.assertEqual( nbins,     self.dists._shp[0].n_bins )
   
   def test_VelocityDistributionsAsArray(self):
-    d = self.dists._vel[0].asarray()
-    self.failUnless( isinstance( d, numpy.ndarray) )
+    vbins, d = self.dists.velocities()
+    self.assertTrue( isinstance( d, numpy.ndarray) )
     nstates, nmeasures, nbins = d.shape
-    self.failUnlessEqual( nstates,   self.dists._vel[0].n_states )
-    self.failUnlessEqual( nmeasures, self.dists._vel[0].n_measures )
-    self.failUnlessEqual( nbins,     self.dists._vel[0].n_bins )
+    self.assertEqual( nstates,   self.dists._vel[0].n_states )
+    self.assertEqual( nmeasures, self.dists._vel[0].n_measures )
+    self.assertEqual( nbins,     self.dists._vel[0].n_bins )
   
+  def test_DistributionViews_OutliveDistributions(self):
+    sbins, d = self.dists.shapes()
+    expected = d.copy()
+    del self.dists
+    self.assertTrue( (d == expected).all() )
+
   def test_VelocityDistributionBinsAsArray(self):
     bins = self.dists._vel[0].bins_as_array()
-    self.failUnless( isinstance( bins, numpy.ndarray) )
+    self.assertTrue( isinstance( bins, numpy.ndarray) )
     nmeasures, nbins = bins.shape
-    self.failUnlessEqual( nmeasures, self.dists._vel[0].n_measures )
-    self.failUnlessEqual( nbins,     self.dists._vel[0].n_bins )
+    self.assertEqual( nmeasures, self.dists._vel[0].n_measures )
+    self.assertEqual( nbins,     self.dists._vel[0].n_bins )
 
 #
 # Declarations 
 #
-ctraj.Whisker_Segments_Measure.restype = POINTER( cMeasurements )
-ctraj.Whisker_Segments_Measure.argtypes = [
-  POINTER( cWhisker_Seg ), # array of whisker segments
-  c_int,                   # number of whisker segments
-  c_int,                   # face x position (px)
-  c_int,                   # face y position (px)
-  c_char ]                 # face orientation ( one of: 'h','v','x' or 'y' )
-
-# ctraj.Whisker_Segments_Measure_With_Bar.restype = POINTER( cMeasurements )
-# ctraj.Whisker_Segments_Measure_With_Bar.argtypes = [
-#   POINTER( cWhisker_Seg ), # array of whisker segments
-#   c_int,                   # number of whisker segments
-#   POINTER( cBar ),         # array of bar locations
-#   c_int,                   # number of bar positions
-#   c_int,                   # face x position (px)
-#   c_int,                   # face y position (px)
-#   c_char ]                 # face orientation ( one of: 'h','v','x' or 'y' )
-
-ctraj.face_point_from_hint.restype = None
-ctraj.face_point_from_hint.argtypes = [
-  POINTER( cWhisker_Seg ), # array of whisker segments
-  c_int,                   # number of whisker segments
-  POINTER( c_char ),       # face hint
-  POINTER( c_int  ),       # (out) face x position (px)
-  POINTER( c_int  ),       # (out) face y position (px)
-  POINTER( c_char ) ]      # (out) face orientation ( one of: 'h','v','x' or 'y' )
-  
+def _check_alloc( result, func, args ):
+  """ errcheck for allocating functions: a NULL result means allocation failed """
+  if not result:
+    raise MemoryError("%s could not allocate a table"%func.__name__)
+  return result
+
+def _declare_prototypes( ctraj ):
+  """ Sets the argument and return types of the library routines used here """
+  ctraj.Load_Params_File.restype = c_int
+  ctraj.Load_Params_File.argtypes = [ c_char_p ]
+
+  ctraj.Whisker_Segments_Measure.restype = POINTER( cMeasurements )
+  ctraj.Whisker_Segments_Measure.argtypes = [
+    POINTER( cWhisker_Seg ), # array of whisker segments
+    c_int,                   # number of whisker segments
+    c_int,                   # face x position (px)
+    c_int,                   # face y position (px)
+    c_char ]                 # face orientation ( one of: 'h','v','x' or 'y' )
+
+  # ctraj.Whisker_Segments_Measure_With_Bar.restype = POINTER( cMeasurements )
+  # ctraj.Whisker_Segments_Measure_With_Bar.argtypes = [
+  #   POINTER( cWhisker_Seg ), # array of whisker segments
+  #   c_int,                   # number of whisker segments
+  #   POINTER( cBar ),         # array of bar locations
+  #   c_int,                   # number of bar positions
+  #   c_int,                   # face x position (px)
+  #   c_int,                   # face y position (px)
+  #   c_char ]                 # face orientation ( one of: 'h','v','x' or 'y' )
+
+  ctraj.face_point_from_hint.restype = None
+  ctraj.face_point_from_hint.argtypes = [
+    POINTER( cWhisker_Seg ), # array of whisker segments
+    c_int,                   # number of whisker segments
+    POINTER( c_char ),       # face hint
+    _P_INT,                  # (out) face x position (px)
+    _P_INT,                  # (out) face y position (px)
+    POINTER( c_char ) ]      # (out) face orientation ( one of: 'h','v','x' or 'y' )
+
+
+  ctraj.Measurements_Table_From_Doubles.restype = POINTER(cMeasurements)
+  ctraj.Measurements_Table_From_Doubles.argtypes = [
+    c_void_p,            # data buffer
+    c_int,               # number of rows
+    c_int ]              # number of columns
+  ctraj.Measurements_Table_From_Doubles.errcheck = _check_alloc
+
+  ctraj.Measurements_Table_Copy_Shape_Data.restype = None
+  ctraj.Measurements_Table_Copy_Shape_Data.argtypes = [
+    POINTER( cMeasurements ), # the table (the source)
+    c_int,                    # number of rows
+    c_void_p ]                # destination
+
+  ctraj.Measurements_Table_Copy_Velocities.restype = None
+  ctraj.Measurements_Table_Copy_Velocities.argtypes = [
+    POINTER( cMeasurements ), # the table (the source)
+    c_int,                    # number of rows
+    c_void_p ]                # destination
+
+  ctraj.Measurements_Table_Data_Base_And_Stride.restype = c_void_p
+  ctraj.Measurements_Table_Data_Base_And_Stride.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    POINTER( c_void_p ),      # (out) head of the velocity block
+    _P_INT,                   # (out) bytes between rows
+    _P_INT ]                  # (out) number of columns
+
+  ctraj.Measurements_Table_From_Filename.restype = POINTER(cMeasurements)
+  ctraj.Measurements_Table_From_Filename.argtypes = [
+    POINTER( c_char ),
+    POINTER( c_char ),
+    _P_INT ]
+
+  ctraj.Measurements_Table_To_Filename.restype = c_int
+  ctraj.Measurements_Table_To_Filename.argtypes = [
+    POINTER( c_char ),        # filename
+    POINTER( c_char ),        # format (NULL to use the default)
+    POINTER( cMeasurements ), # table
+    c_int ]                   # number of rows
+
+  ctraj.Free_Measurements_Table.restype = None
+  ctraj.Free_Measurements_Table.argtypes = [ POINTER( cMeasurements ) ]
+
+  ctraj.Measurements_Table_Data_To_Doubles.restype = None
+  ctraj.Measurements_Table_Data_To_Doubles.argtypes = [
+    POINTER( cMeasurements ), # the table (the source)
+    c_int,                    # number of rows
+    c_void_p ]                # destination
+
+  ctraj.Measurements_Table_Size_Select_State.restype = c_int
+  ctraj.Measurements_Table_Size_Select_State.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int ]                   # state
+
+  ctraj.Measurements_Table_State_Histogram.restype = c_int
+  ctraj.Measurements_Table_State_Histogram.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_void_p,                 # (in/out) counts per state
+    c_int ]                   # number of states counted
+
+  ctraj.Measurements_Table_Select_Time_And_Mask_By_State.restype = None
+  ctraj.Measurements_Table_Select_Time_And_Mask_By_State.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # state
+    c_void_p,                 # (out) time
+    c_void_p ]                # (out) valid velocity mask
+
+  ctraj.Measurements_Table_Select_Velocities_By_State.restype = None
+  ctraj.Measurements_Table_Select_Velocities_By_State.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # state
+    c_void_p ]                # (out) velocities
+
+  ctraj.Measurements_Table_Select_Shape_By_State.restype = None
+  ctraj.Measurements_Table_Select_Shape_By_State.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # state
+    c_void_p ]                # (out) shape data
+
+  ctraj.Measurements_Table_Select_All_By_State.restype = None
+  ctraj.Measurements_Table_Select_All_By_State.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # state
+    c_void_p,                 # (out) time
+    c_void_p,                 # (out) valid velocity mask
+    c_void_p,                 # (out) shape data
+    c_void_p ]                # (out) velocities
+
+  ctraj.Measurements_Table_Select_All_States.restype = None
+  ctraj.Measurements_Table_Select_All_States.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # number of states
+    c_void_p,                 # (in) offsets of each state's rows
+    c_void_p,                 # (out) time
+    c_void_p,                 # (out) valid velocity mask
+    c_void_p,                 # (out) shape data
+    c_void_p ]                # (out) velocities
+
+  ctraj.Measurements_Table_Set_Constant_Face_Position.restype = None
+  ctraj.Measurements_Table_Set_Constant_Face_Position.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # face x position (px)
+    c_int ]                   # face y position (px)
+
+  ctraj.Measurements_Table_Set_Follicle_Position_Indices.restype = None
+  ctraj.Measurements_Table_Set_Follicle_Position_Indices.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # column of the follicle x position
+    c_int ]                   # column of the follicle y position
+
+  ctraj.Measurements_Table_Size_Select_State_Sorted.restype = c_int
+  ctraj.Measurements_Table_Size_Select_State_Sorted.argtypes = [
+    POINTER( cMeasurements ), # the table, sorted by state
+    c_int,                    # number of rows
+    c_int ]                   # state
+
+  for _sort in [ ctraj.Sort_Measurements_Table_State_Time,
+                 ctraj.Sort_Measurements_Table_Time,
+                 ctraj.Sort_Measurements_Table_Time_Face,
+                 ctraj.Measurements_Table_Compute_Velocities ]:
+    _sort.restype = None
+    _sort.argtypes = [
+      POINTER( cMeasurements ), # the table
+      c_int ]                   # number of rows
+
+  for _query in [ ctraj.Measurements_Table_Is_Sorted_By_State_Time,
+                  ctraj.Measurements_Table_Is_Sorted_By_Time,
+                  ctraj.Measurements_Table_Any_Valid_Velocity ]:
+    _query.restype = c_int
+    _query.argtypes = [
+      POINTER( cMeasurements ), # the table
+      c_int ]                   # number of rows
+
+  ctraj._count_n_states.restype = c_int
+  ctraj._count_n_states.argtypes = [
+    POINTER( cMeasurements ), # the table
+    c_int,                    # number of rows
+    c_int,                    # nonzero if the table is sorted by state
+    _P_INT,                   # (out) minimum state
+    _P_INT ]                  # (out) maximum state
+
+  ctraj.Alloc_Distributions.restype = POINTER(cDistributions)
+  ctraj.Alloc_Distributions.argtypes = [
+    c_int,  # n_bins
+    c_int,  # n_measures
+    c_int ] # n_states
+
+  ctraj.Free_Distributions.restype = None
+  ctraj.Free_Distributions.argtypes = [ POINTER(cDistributions) ]
+
+  ctraj.Copy_Distribution_To_Doubles.restype = None
+  ctraj.Copy_Distribution_To_Doubles.argtypes = [
+    POINTER( cDistributions ), # the distributions (the source)
+    c_void_p ]                 # destination
+
+  ctraj.Distributions_Bins_To_Doubles.restype = None
+  ctraj.Distributions_Bins_To_Doubles.argtypes = [
+    POINTER( cDistributions ), # the distributions (the source)
+    c_void_p ]                 # destination
+
+  for _op in [ ctraj.Distributions_Normalize,
+               ctraj.Distributions_Apply_Log2 ]:
+    _op.restype = None
+    _op.argtypes = [ POINTER( cDistributions ) ]
+
+  ctraj.Build_Distributions.restype = POINTER( cDistributions )
+  ctraj.Build_Distributions.argtypes = [
+    POINTER( cMeasurements ), # measurements table
+    c_int,                    # number of rows
+    c_int ]                   # number of bins
+
+  ctraj.Build_Velocity_Distributions.restype = POINTER( cDistributions )
+  ctraj.Build_Velocity_Distributions.argtypes = [
+    POINTER( cMeasurements ), # measurements table
+    c_int,                    # number of rows
+    c_int ]                   # number of bins
+
+  ctraj.Solve.restype = None
+  ctraj.Solve.argtypes = [
+    POINTER( cMeasurements ), # table
+    c_int,                    # number of rows
+    c_int,                    # number of shape bins
+    c_int ]                   # number of velocity bins
+
+  ctraj.Measurements_Tables_Get_Diff_Frames.restype = _P_INT
+  ctraj.Measurements_Tables_Get_Diff_Frames.argtypes = [
+    POINTER( cMeasurements ), #table A
+    c_int,                    #number of rows for table A
+    POINTER( cMeasurements ), #table B
+    c_int,                    #number of rows for table B
+    _P_INT ]                  #size of returned static array
+
+  ctraj.Measurements_Table_Estimate_Best_Threshold.restype = c_double
+  ctraj.Measurements_Table_Estimate_Best_Threshold.argtypes = [
+    POINTER( cMeasurements ), # table
+    c_int,                    # n_rows
+    c_int,                    # column index of the feature to use
+    c_double,                 # low (px)
+    c_double,                 # high (px)
+    c_int,                    # is_gt
+    _P_INT                    # (output) target count
+  ]
+
+ctraj = _load_library() # `import trace` loads libwhisk anyway, so there is nothing to gain by deferring this
+
 
-ctraj.Measurements_Table_From_Doubles.restype = POINTER(cMeasurements)
-ctraj.Measurements_Table_From_Doubles.argtypes = [
-  POINTER( c_double ), # data buffer
-  c_int,               # number of rows
-  c_int ]              # number of columns
-
-ctraj.Measurements_Table_Copy_Shape_Data.restype = None
-ctraj.Measurements_Table_Copy_Shape_Data.argtypes = [
-  POINTER( cMeasurements ), # the table (the source)
-  c_int,                    # number of rows
-  POINTER( c_double ) ]     # destination
-
-ctraj.Measurements_Table_Copy_Velocities.restype = None
-ctraj.Measurements_Table_Copy_Velocities.argtypes = [
-  POINTER( cMeasurements ), # the table (the source)
-  c_int,                    # number of rows
-  POINTER( c_double ) ]     # destination
-
-ctraj.Measurements_Table_From_Filename.restype = POINTER(cMeasurements)
-ctraj.Measurements_Table_From_Filename.argtypes = [
-  POINTER( c_char ),
-  POINTER( c_char ),
-  POINTER( c_int  ) ]
-
-ctraj.Alloc_Distributions.restype = POINTER(cDistributions)
-ctraj.Alloc_Distributions.argtypes = [
-  c_int,  # n_bins
-  c_int,  # n_measures
-  c_int ] # n_states
-
-ctraj.Free_Distributions.restype = None
-ctraj.Free_Distributions.argtypes = [ POINTER(cDistributions) ]
-
-ctraj.Build_Distributions.restype = POINTER( cDistributions )
-ctraj.Build_Distributions.argtype = [
-  POINTER( cMeasurements ), # measurements table
-  c_int,                    # number of rows
-  c_int ]                   # number of bins
-
-ctraj.Build_Velocity_Distributions.restype = POINTER( cDistributions )
-ctraj.Build_Velocity_Distributions.argtype = [
-  POINTER( cMeasurements ), # measurements table
-  c_int,                    # number of rows
-  c_int ]                   # number of bins
-
-ctraj.Solve.restype = None
-ctraj.argtypes = [
-  POINTER( cMeasurements ), # table
-  c_int,                    # number of rows
-  c_int ]                   # number of bins
-
-ctraj.Measurements_Tables_Get_Diff_Frames.restype = POINTER( c_int )
-ctraj.Measurements_Tables_Get_Diff_Frames.argtypes = [
-  POINTER( cMeasurements ), #table A
-  c_int,                    #number of rows for table A
-  POINTER( cMeasurements ), #table B                   
-  c_int,                    #number of rows for table B
-  POINTER( c_int ) ]        #size of returned static array
-
-ctraj.Measurements_Table_Estimate_Best_Threshold.restype = c_double
-ctraj.Measurements_Table_Estimate_Best_Threshold.argtypes = [
-  POINTER( cMeasurements ), # table
-  c_int,                    # n_rows
-  c_int,                    # column index of the feature to use
-  c_double,                 # low (px)
-  c_double,                 # high (px)
-  c_int,                    # is_gt
-  POINTER(c_int)            # (output) target count
-]
+#
+# Raw entry points
+#
+# Addresses of the select and velocity routines (`addresses()`) for callers
+# that need to skip ctypes, e.g. numba jitted loops.  Pass the table as an
+# address, `cast(table._measurements, c_void_p).value`, and numpy buffers as
+# `a.ctypes.data`.
+#
+# >>> import numba
+# >>> select = numba_function( 'Measurements_Table_Select_Shape_By_State' )
+# >>> @numba.njit
+# ... def f(table, nrows, state, out):
+# ...   select(table, nrows, state, out)
+#
 
+def function_address( name ):
+  """ Returns the address of the C routine `name` as an integer """
+  return cast( getattr(ctraj,name), c_void_p ).value
+
+def addresses():
+  """ Returns a dict mapping the names of the select and velocity routines to their addresses """
+  return dict( [ (name, function_address(name)) for name in 
+                 [ 'Measurements_Table_Compute_Velocities',
+                   'Measurements_Table_Size_Select_State',
+                   'Measurements_Table_Select_Time_And_Mask_By_State',
+                   'Measurements_Table_Select_Velocities_By_State',
+                   'Measurements_Table_Select_Shape_By_State',
+                   'Measurements_Table_Select_All_By_State',
+                   'Measurements_Table_Select_All_States' ] ] )
+
+def numba_signature( name ):
+  """ Returns the numba signature of the C routine `name`.  Pointers map to voidptr. """
+  from numba import types
+  def totype(t):
+    if t is None:
+      return types.void
+    return { c_int:types.int32, c_double:types.float64 }.get( t, types.voidptr )
+  f = getattr(ctraj,name)
+  return totype(f.restype)( *[totype(t) for t in f.argtypes] )
+
+def numba_function( name ):
+  """ Returns the C routine `name` as a numba external function callable from nopython code """
+  import llvmlite.binding as llvm
+  from numba import types
+  llvm.add_symbol( name, function_address(name) )
+  return types.ExternalFunction( name, numba_signature(name) )
 
 if __name__=='__main__':
   testcases = [ 
@@ -915,8 +1322,8 @@ if __name__=='__main__':
                 Tests_MeasurementsTable_FromFile ,
                 Tests_Distributions 
                 ]
-  suite = reduce( lambda a,b: a if a.addTest(b) else a, 
-                  map( unittest.defaultTestLoader.loadTestsFromTestCase, testcases ) 
-                )
+  suite = unittest.TestSuite()
+  for testcase in testcases:
+    suite.addTests( unittest.defaultTestLoader.loadTestsFromTestCase(testcase) )
   suite.addTest( doctest.DocTestSuite() )
   runner = unittest.TextTestRunner(verbosity=2,descriptions=1).run(suite)
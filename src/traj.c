@@ -182,7 +182,7 @@ void Copy_Distribution_To_Doubles( Distributions *this, double *destination )
 
 SHARED_EXPORT
 void Distributions_Bins_To_Doubles( Distributions *this, double *destination )
-{ int stride = this->n_measures;
+{ int stride = this->n_bins;
   int i,j;
   for(i=0; i<this->n_measures; i++)
   { double mn  = this->bin_min[i],
@@ -218,6 +218,7 @@ SHARED_EXPORT
 Measurements *Measurements_Table_From_Doubles( double *raw, int n_rows, int n_cols )
 { int n = n_cols - 3;
   Measurements *table = Alloc_Measurements_Table( n_rows, n );
+  if( !table ) return NULL;
   while( n_rows-- )
   { double *rawrow = raw + n_cols*n_rows;
     Measurements *row = table + n_rows;
@@ -289,6 +290,21 @@ void Measurements_Table_Copy_Velocities( Measurements *table, int n_rows, double
   memcpy( buffer, table[0].data - n*table[0].row + n*n_rows, n*n_rows*sizeof(double) );
 }
 
+// Returns the head of the block holding the shape data for every row.  The
+// velocities follow in a block of the same size, returned in `velocity`.
+// Rows are in storage order (see the `row` field), `row_stride` bytes apart,
+// each with `n_cols` doubles.  These are the buffers copied by
+// `Measurements_Table_Copy_Shape_Data` and `Measurements_Table_Copy_Velocities`.
+SHARED_EXPORT
+double *Measurements_Table_Data_Base_And_Stride( Measurements *table, int n_rows, double **velocity, int *row_stride, int *n_cols )
+{ int n = table[0].n;
+  double *head = table[0].data - n*table[0].row;
+  *velocity   = head + n*n_rows;
+  *row_stride = n*sizeof(double);
+  *n_cols     = n;
+  return head;
+}
+
 // This does not initialize memory in added rows
 // Velocities need to be recomputed after this
 SHARED_EXPORT
@@ -334,6 +350,46 @@ int Measurements_Table_Size_Select_State( Measurements *table, int n_rows, int s
   return count;
 }
 
+// Returns the index of the first row with a state of at least `state`
+// in a table sorted by state.
+static int _state_lower_bound( Measurements *sorted_table, int n_rows, int state )
+{ int lo = 0,
+      hi = n_rows;
+  while( lo < hi )
+  { int mid = lo + (hi-lo)/2;
+    if( sorted_table[mid].state < state )
+      lo = mid+1;
+    else
+      hi = mid;
+  }
+  return lo;
+}
+
+// Returns the number of rows with the queried state in a table sorted by state
+// (e.g. after `Sort_Measurements_Table_State_Time`).
+// Binary searches for the ends of the state's block, so only O(log n_rows) rows are touched.
+SHARED_EXPORT
+int Measurements_Table_Size_Select_State_Sorted( Measurements *sorted_table, int n_rows, int state )
+{ return _state_lower_bound( sorted_table, n_rows, state+1 )
+       - _state_lower_bound( sorted_table, n_rows, state   );
+}
+
+// Counts the rows in each state in [0,out_len) into `out`, which is not cleared first.
+// Returns the number of rows with a state outside that range (e.g. -1 for junk).
+// Scans once over the table.
+SHARED_EXPORT
+int Measurements_Table_State_Histogram( Measurements *table, int n_rows, int *out, int out_len )
+{ int other = 0;
+  while(n_rows--)
+  { int s = table[n_rows].state;
+    if( s>=0 && s<out_len )
+      out[s]++;
+    else
+      other++;
+  }
+  return other;
+}
+
 // Selects rows according to their state and returns the `time` and `valid_velocity` arrays.
 // time and mask should be the appropriate size. See `Measurements_Table_Size_Select_State`
 SHARED_EXPORT
@@ -377,6 +433,53 @@ void Measurements_Table_Select_Shape_By_State( Measurements *table, int n_rows,
   }
 }
 
+// Selects rows according to their state and returns time, valid_velocity,
+// shape data and velocities in a single pass over the table.
+// Outputs should be the appropriate size. See `Measurements_Table_Size_Select_State`
+SHARED_EXPORT
+void Measurements_Table_Select_All_By_State( Measurements *table, int n_rows, int state, double *time, int *mask, double *shape, double *velocity )
+{ int i=0;
+  int j=0;
+  int n = table[0].n;
+  for( i=0; i<n_rows; i++ )
+  { Measurements *row = table + i;
+    if( row->state == state )
+    { time[j] = row->fid;
+      mask[j] = row->valid_velocity;
+      memcpy( shape    + j*n, row->data,     n*sizeof(double) );
+      memcpy( velocity + j*n, row->velocity, n*sizeof(double) );
+      j++;
+    }
+  }
+}
+
+// Selects time, valid_velocity, shape data and velocities for states 0 to
+// n_states-1 in one pass.  Rows for state k are written to output rows
+// offsets[k] up to offsets[k+1], in table order.  Rows with other states are
+// skipped.
+// `offsets` (n_states+1 entries) should hold the prefix sum of the counts from
+// `Measurements_Table_State_Histogram`.  It is used as a cursor and restored
+// before returning.
+SHARED_EXPORT
+void Measurements_Table_Select_All_States( Measurements *table, int n_rows, int n_states, int *offsets, double *time, int *mask, double *shape, double *velocity )
+{ int i,k;
+  int n = table[0].n;
+  for( i=0; i<n_rows; i++ )
+  { Measurements *row = table + i;
+    int s = row->state;
+    if( s>=0 && s<n_states )
+    { int j = offsets[s]++;
+      time[j] = row->fid;
+      mask[j] = row->valid_velocity;
+      memcpy( shape    + j*n, row->data,     n*sizeof(double) );
+      memcpy( velocity + j*n, row->velocity, n*sizeof(double) );
+    }
+  }
+  for( k=n_states; k>0; k-- )  // each cursor stopped at the next block's start
+    offsets[k] = offsets[k-1];
+  offsets[0] = 0;
+}
+
 int test_Measurements_Table_FileIO( char* filename,  Measurements *table, int n_rows )
 { Measurements *t2;
   int nr2,i;
@@ -533,14 +636,26 @@ void Enumerate_Measurements_Table( Measurements *table, int nrows )
     table[i].row = i;
 }
 
+// Returns 1 if `table` is already in the order given by `cmp`.
+// Sorts use this to skip the O(n log n) qsort for presorted input.
+static int _is_sorted( Measurements *table, int nrows, int (*cmp)(const void*, const void*) )
+{ int i;
+  for( i=1; i<nrows; i++ )
+    if( cmp( table+i-1, table+i ) > 0 )
+      return 0;
+  return 1;
+}
+
 SHARED_EXPORT
 void Sort_Measurements_Table_State_Time( Measurements *table, int nrows )
-{ qsort( table, nrows, sizeof(Measurements), cmp_sort_state_time );
+{ if( _is_sorted( table, nrows, cmp_sort_state_time ) ) return;
+  qsort( table, nrows, sizeof(Measurements), cmp_sort_state_time );
 }
 
 SHARED_EXPORT
 void Sort_Measurements_Table_Time( Measurements *table, int nrows )
-{ qsort( table, nrows, sizeof(Measurements), cmp_sort_time );
+{ if( _is_sorted( table, nrows, cmp_sort_time ) ) return;
+  qsort( table, nrows, sizeof(Measurements), cmp_sort_time );
 }
 
 SHARED_EXPORT
@@ -558,7 +673,26 @@ void Sort_Measurements_Table_Time_State_Face( Measurements *table, int nrows )
 { qsort( table, nrows, sizeof(Measurements), cmp_sort_time_state_face_order );
 }
 
- double _diff(double a, double b)
+SHARED_EXPORT
+int Measurements_Table_Is_Sorted_By_State_Time( Measurements *table, int nrows )
+{ return _is_sorted( table, nrows, cmp_sort_state_time );
+}
+
+SHARED_EXPORT
+int Measurements_Table_Is_Sorted_By_Time( Measurements *table, int nrows )
+{ return _is_sorted( table, nrows, cmp_sort_time );
+}
+
+SHARED_EXPORT
+int Measurements_Table_Any_Valid_Velocity( Measurements *table, int nrows )
+{ while(nrows--)
+    if( table[nrows].valid_velocity )
+      return 1;
+  return 0;
+}
+
+// Squared difference.  Static so the per-field loops below can inline it and vectorize.
+static double _diff(double a, double b)
 { double c = a-b;
   return c*c;
 }
@@ -577,11 +711,11 @@ void Measurements_Table_Compute_Velocities( Measurements *sorted_table, int n_ro
   { Measurements *a = sorted_table + n_rows - 1,
                  *b = sorted_table + n_rows;
     if( (b->state >= 0) && (b->fid - a->fid) == 1 )
-    { double *d  = b->velocity,
-             *bd = b->data,
-             *ad = a->data;;
+    { double *d  = b->velocity;
+      const double *bd = b->data,
+                   *ad = a->data;
       for( i=0 ; i<n ; i++)  // for each field
-        d[i] = _diff( bd[i] , ad[i] ); // compute difference
+        d[i] = _diff( bd[i] , ad[i] ); // compute (squared) difference
       b->valid_velocity = 1;
     } else
     { b->valid_velocity = 0;
@@ -639,6 +773,15 @@ Distributions *Alloc_Distributions_For_State_Sorted_Table( Measurements *sorted_
                               _count_n_states( sorted_table, n_rows, 1, minstate, maxstate ) ); // n_states
 }
 
+// Returns the histogram bin for `v`, clamped to [0,n_bins).
+// Matches the lookup in Eval_Likelihood_Log2, so a measurement is scored
+// against the bin it was counted in.  Values at the top of the range used to
+// index one past the last bin.
+static int _bin_index( double v, double mn, double delta, int n_bins )
+{ int ibin = (int) floor( (v - mn) / delta );
+  return CLAMP( ibin, 0, n_bins-1 );
+}
+
 // The range of these histograms covers the state space sampled by the movie
 SHARED_EXPORT
 Distributions *Build_Distributions( Measurements *sorted_table, int n_rows, int n_bins )
@@ -686,19 +829,8 @@ Distributions *Build_Distributions( Measurements *sorted_table, int n_rows, int
     int istate = mrow->state - minstate;
     double *hist = d->data + istate * state_stride;
     for( j=0; j<n; j++ )
-    { int ibin = (int) floor(  (data[j] - mn[j]) / delta[j]  );
+    { int ibin = _bin_index( data[j], mn[j], delta[j], n_bins );
       hist[ j*measure_stride + ibin ] ++;
-#ifdef DEBUG_BUILD_DISTRIBUTIONS
-      if(  !( ibin >= 0 && ibin < n_bins ) )
-      { debug("ibin:  %d\n",ibin);
-        debug("nbins: %d\n",n_bins);
-        debug(" data[%d]: %f\n", j,  data[j] );
-        debug("   mn[%d]: %f\n", j,    mn[j] );
-        debug("   mx[%d]: %f\n", j,    mx[j] );
-        debug("delta[%d]: %f\n", j, delta[j] );
-      }
-      assert( ibin >= 0 && ibin < n_bins );
-#endif
     }
   }
 
@@ -814,19 +946,8 @@ Distributions *Build_Velocity_Distributions( Measurements *sorted_table, int n_r
       int istate   = mrow->state - minstate;
       double *hist = d->data + istate * state_stride;
       for( j=0; j<n; j++ )
-      { int ibin = (int) floor(  (data[j] - mn[j]) / delta[j]  );
+      { int ibin = _bin_index( data[j], mn[j], delta[j], n_bins );
         hist[ j*measure_stride + ibin  ] ++;
-#ifdef DEBUG_BUILD_VELOCITY_DISTRIBUTIONS
-        if(  !( ibin >= 0 && ibin < n_bins ) )
-        { debug("ibin:  %d\n",ibin);
-          debug("nbins: %d\n",n_bins);
-          debug(" data[%d]: %f\n", j,  data[j] );
-          debug("   mn[%d]: %f\n", j,    mn[j] );
-          debug("   mx[%d]: %f\n", j,    mx[j] );
-          debug("delta[%d]: %f\n", j, delta[j] );
-        }
-        assert( ibin >= 0 && ibin < n_bins );
-#endif
       }
     }
   }
@@ -868,19 +989,8 @@ Distributions *Build_Velocity_Distributions( Measurements *sorted_table, int n_r
         { double *tdata = this[j].data;
           for(k=0; k<n; k++)
           { double diff = _diff( tdata[k], ldata[k] );
-            int ibin = (int) floor(  (diff - mn[k]) / delta[k]  );
+            int ibin = _bin_index( diff, mn[k], delta[k], n_bins );
             hist[ k*measure_stride + ibin  ] ++;
-#ifdef DEBUG_BUILD_VELOCITY_DISTRIBUTIONS
-            if(  !( ibin >= 0 && ibin < n_bins ) )
-            { debug("   ibin:  %d\n",ibin);
-              debug("   nbins: %d\n",n_bins);
-              debug("    data[%d]: %f\n", j,  diff    );
-              debug("      mn[%d]: %f\n", j,    mn[k] );
-              debug("      mx[%d]: %f\n", j,    mx[k] );
-              debug("   delta[%d]: %f\n", j, delta[k] );
-            }
-            assert( ibin >= 0 && ibin < n_bins );
-#endif
           }
         }
       }